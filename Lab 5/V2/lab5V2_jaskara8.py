@@ -30,56 +30,257 @@
 #
 import numpy as np
 from scipy import stats
-import csv
-import matplotlib.pyplot as plt
+from scipy.interpolate import CubicSpline
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import zipfile
 
-def main():
-    data = loaddata('horizons_results')  # Load data from the 'horizons_results' file
-    data = locate(data)  # Locate the perihelia in the data
-    data = select(data, 50, ('Jan', 'Feb', 'Mar'))  # Select data based on year and month at half-century intervals
-    data = refine(data, 'horizons_results')  # Refine the data
-    makeplot(data, 'horizons_results')  # Make a plot of the data
-    savedata(data, 'horizons_results')  # Save the selected data to a file
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')  # Month names used by Horizons
 
-def refine(data, filename):
+def main(argv=None):
     """
-    Refine the data by loading additional files and locating perihelia.
+    Run the program. Without arguments it shows the plot as before; with --batch it
+    only writes the results, so it can run under a scheduler.
+
+    Args:
+        argv (list): The command line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Mercury's perihelion precession from Horizons ephemerides")
+    parser.add_argument('--input', default='horizons_results', help="base name of the Horizons files")
+    parser.add_argument('--output', default='horizons_results', help="base name of the output files")
+    parser.add_argument('--ystep', type=int, default=50, help="year step of the selected perihelia")
+    parser.add_argument('--months', default='Jan,Feb,Mar', help="comma-separated months of the selected perihelia")
+    parser.add_argument('--method', default='files', choices=('files', 'parabola', 'spline'),
+                        help="refinement method, the minute-step files by default")
+    parser.add_argument('--compare', action='store_true', help="with --method parabola or spline, compare against the minute-step files")
+    parser.add_argument('--workers', type=int, default=None, help="processes loading the per-date files")
+    parser.add_argument('--batch', action='store_true', help="write CSV and JSON results without showing the plot")
+    parser.add_argument('--plot', action='store_true', help="in batch mode, also save the plot with the Agg backend")
+    parser.add_argument('--binary', action='store_true', help="also save the columns to an .npz file")
+    args = parser.parse_args(argv)
+    month = tuple(m.strip() for m in args.months.split(','))
+    try:
+        monthnumbers(month)  # Report a misspelt month before any file is loaded
+    except ValueError as error:
+        parser.error(str(error))
+    if args.compare and args.method == 'files':
+        parser.error("--compare needs --method parabola or spline")
+    (data, source) = run(args.input, args.ystep, month, args.method, args.workers)
+    comparison = None
+    if args.compare:
+        coarse = cols2dicts(select(locate(source), args.ystep, month))  # Perihelia before refinement
+        comparison = compare(data, refine(coarse, args.input, workers=args.workers))  # Validate against the minute-step files
+    if args.batch:
+        savedata(data, args.output, args.binary)  # Save the selected data to a file
+        savejson(data, args.output, comparison)  # Save the precession, the fit and any comparison to a file
+        if args.plot:
+            makeplot(data, args.output, show=False)  # Save the plot without displaying it
+        return
+    makeplot(data, args.output)  # Make a plot of the data
+    savedata(data, args.output, args.binary)  # Save the selected data to a file
+
+def run(filename='horizons_results', ystep=50, month=('Jan', 'Feb', 'Mar'), method='files', workers=None):
+    """
+    Run the pipeline from loading the data to refining the selected perihelia, without plotting.
+
+    Args:
+        filename (str): The base name of the Horizons files.
+        ystep (int): The year step.
+        month (tuple): The months to select.
+        method (str): The refinement method, see refine.
+        workers (int): The number of processes loading the per-date files.
+
+    Returns:
+        tuple: The refined perihelia as a list of dictionaries, and the columns of the main file.
+    """
+    source = loadcolumns(filename)  # Load data from the 'horizons_results' file
+    data = locate(source)  # Locate the perihelia in the data
+    data = select(data, ystep, month)  # Select data based on year and month
+    data = cols2dicts(data)  # Convert the selected perihelia into a list of dictionaries
+    data = refine(data, filename, method, source, workers)  # Refine the data
+    return (data, source)
+
+def refine(data, filename, method='files', source=None, workers=None):
+    """
+    Refine the data by loading additional files and locating perihelia,
+    or by interpolating between the samples of the main file.
     Args:
         data (list): The input data.
         filename (str): The base name of the files to load.
+        method (str): 'files' to load the per-date files, or 'parabola' or 'spline' to interpolate.
+        source (dict): The columns of the main file, required when interpolating.
+        workers (int): The number of processes loading the per-date files, or None for one per core.
     Returns:
         list: A list of dictionaries containing the first perihelion of each loaded file.
     """
+    if method != 'files':
+        return interpolate(data, source, method)  # Estimate each perihelion without extra file I/O
+    files = [filename + '_' + datum['strdate'] + '.txt' for datum in data]  # Construct the file names to load
     refined_data = []  # List to store the refined data
-    for datum in data:
-        suffix = datum['strdate']  # Get the suffix from the 'strdate' of each dict entry
-        file_to_load = filename + '_' + suffix + '.txt'  # Construct the file name to load
-        loaded_data = loaddata(file_to_load)  # Load the additional file
-        perihelion = locate(loaded_data)[0]  # Locate the first perihelion in the loaded data
-        refined_data.append(perihelion)  # Add the perihelion to the refined data list
+    for loaded_data in loadmany(files, workers):  # Load the additional files in parallel
+        if loaded_data is not None:
+            perihelion = cols2dicts(locate(loaded_data))[0]  # Locate the first perihelion in the loaded data
+            refined_data.append(perihelion)  # Add the perihelion to the refined data list
     return refined_data  # Return the refined data
 
-def savedata(data, filename):
+def interpolate(data, source, method='parabola'):
+    """
+    Refine the data to sub-step precision from the samples around each perihelion.
+
+    Args:
+        data (list): The perihelia to refine, taken from the source columns.
+        source (dict): The columns of the file the perihelia were located in.
+        method (str): 'parabola' for a three-point fit, or 'spline' for a cubic spline.
+
+    Returns:
+        list: A list of dictionaries containing the refined perihelia.
+    """
+    numdate = np.array([datum['numdate'] for datum in data])
+    index = np.searchsorted(source['numdate'], numdate)  # Rows of the perihelia in the source columns
+    if method == 'parabola':
+        cols = parabola(source, index)
+    elif method == 'spline':
+        cols = spline(source, index)
+    else:
+        raise ValueError("unknown refinement method: " + method)
+    return cols2dicts(cols)  # Return the refined data
+
+def parabola(source, index):
+    """
+    Fit a parabola through the distances at each perihelion and its two neighbours.
+
+    Args:
+        source (dict): The columns of the file the perihelia were located in.
+        index (numpy.ndarray): The rows of the perihelia.
+
+    Returns:
+        dict: The columns of the refined perihelia.
+    """
+    t = source['numdate']
+    c0, cm, cp = source['coord'][index], source['coord'][index-1], source['coord'][index+1]
+    r0, rm, rp = (np.sqrt(np.einsum('ij,ij->i', c, c)) for c in (c0, cm, cp))
+    delta = (rm-rp)/(2*(rm-2*r0+rp))  # Offset of the vertex in steps, between -1/2 and 1/2
+    step = (t[index+1]-t[index-1])/2  # Uniform step around each perihelion
+    numdate = t[index]+delta*step
+    d = delta[:, None]
+    coord = c0+d*(cp-cm)/2+d*d*(cp-2*c0+cm)/2  # Quadratic interpolation of each coordinate
+    strdate = jd2str(numdate)
+    return {'numdate': numdate, 'strdate': strdate, 'coord': coord, **datecols(strdate)}
+
+def spline(source, index, window=3):
+    """
+    Fit a cubic spline through the distances around each perihelion and find its minimum.
+
+    Args:
+        source (dict): The columns of the file the perihelia were located in.
+        index (numpy.ndarray): The rows of the perihelia.
+        window (int): The number of samples on each side of the perihelion to fit.
+
+    Returns:
+        dict: The columns of the refined perihelia.
+    """
+    t, coords = source['numdate'], source['coord']
+    numdate = np.empty(len(index))
+    coord = np.empty((len(index), 3))
+    for n, k in enumerate(index):
+        lo, hi = max(k-window, 0), min(k+window+1, len(t))
+        x = t[lo:hi]-t[k]  # Times relative to the perihelion sample, to keep the fit well conditioned
+        path = CubicSpline(x, coords[lo:hi])  # Spline through each coordinate
+        dist = CubicSpline(x, np.linalg.norm(coords[lo:hi], axis=1))  # Spline through the distances
+        roots = dist.derivative().roots(extrapolate=False)
+        roots = roots[(roots >= t[k-1]-t[k]) & (roots <= t[k+1]-t[k])]  # Stationary points next to the sample
+        best = roots[np.argmin(dist(roots))] if len(roots) else 0.0
+        numdate[n] = t[k]+best
+        coord[n] = path(best)
+    strdate = jd2str(numdate)
+    return {'numdate': numdate, 'strdate': strdate, 'coord': coord, **datecols(strdate)}
+
+def jd2str(numdate):
+    """
+    Convert Julian dates into calendar date strings.
+
+    Args:
+        numdate (numpy.ndarray): The Julian dates.
+
+    Returns:
+        numpy.ndarray: The Gregorian dates as bytes, e.g. b'1800-Mar-21'.
+    """
+    j = np.floor(np.asarray(numdate)+0.5).astype(np.int64)  # Julian day number of each date
+    f = j+1401+(((4*j+274277)//146097)*3)//4-38
+    e = 4*f+3
+    h = 5*((e % 1461)//4)+2
+    day = (h % 153)//5+1
+    month = (h//153+2) % 12+1
+    year = e//1461-4716+(14-month)//12
+    return np.array(['%04d-%s-%02d' % (y, MONTHS[m-1], d) for y, m, d in zip(year, month, day)], 'S11')
+
+def compare(data, check):
+    """
+    Print the difference between two sets of refined perihelia.
+
+    Args:
+        data (list): The perihelia refined by interpolation.
+        check (list): The perihelia refined from the per-date files.
+
+    Returns:
+        list: A dictionary per checked perihelion with its date string, dt in minutes and dr in km.
+    """
+    rows = []  # List to store the differences
+    print("STRDATE      DT(min)   DR(km)")
+    for other in check:
+        if not data:
+            break  # Nothing to compare with
+        datum = min(data, key=lambda datum: abs(datum['numdate']-other['numdate']))  # Same perihelion in the other set
+        dt = (datum['numdate']-other['numdate'])*24*60  # Time difference in minutes
+        dr = np.linalg.norm(np.subtract(datum['coord'], other['coord']))  # Position difference in km
+        print(f"{other['strdate']}  {dt:8.2f}  {dr:7.1f}")
+        rows.append({'strdate': str(other['strdate']), 'dt': float(dt), 'dr': float(dr)})
+    return rows
+
+def savedata(data, filename, binary=False):
     """
-    Save the selected data to a CSV file.
+    Save the selected data to a CSV file, formatting whole columns at once.
     Args:
-        data (list): The data to save.
+        data (dict or list): The data to save, as columns or as a list of dictionaries.
         filename (str): The name of the output file.
+        binary (bool): Whether to also save the columns to an .npz file.
+    """
+    if isinstance(data, dict):
+        numdate, strdate, coord = data['numdate'], data['strdate'].astype(str), data['coord']
+    else:
+        numdate = np.array([datum['numdate'] for datum in data], float)  # Extract the numerical dates
+        strdate = [datum['strdate'] for datum in data]  # Extract the date strings
+        coord = np.array([datum['coord'] for datum in data], float).reshape(-1, 3)  # Extract the coordinates
+    row = '{:.6f},{},{:.6f},{:.6f},{:.6f}\r\n'.format  # Same text and line ending as csv.writer
+    lines = map(row, numdate.tolist(), strdate, coord[:, 0].tolist(), coord[:, 1].tolist(), coord[:, 2].tolist())
+    with open(filename + '.csv', 'w', newline='') as file:
+        file.write("NUMDATE,STRDATE,XCOORD,YCOORD,ZCOORD\r\n")  # Write the header
+        file.write(''.join(lines))  # Write the data in one call
+    if binary:
+        np.savez(filename + '.npz', numdate=numdate, strdate=np.asarray(strdate, 'S11'), coord=coord)  # Same columns as loadcolumns
+
+def savejson(data, filename, comparison=None):
     """
-    filename += '.csv'  # Add the .csv extension if it is not present
-    with open(filename, 'w', newline='') as file:
-        writer = csv.writer(file)
-        
-        # Write the header
-        writer.writerow(["NUMDATE","STRDATE","XCOORD","YCOORD","ZCOORD"])
-        
-        # Write the data
-        for datum in data:
-            numdate = datum['numdate']  # Extract the numerical date from the datum dictionary
-            strdate = datum['strdate']  # Extract the date string from the datum dictionary
-            coord = ','.join(map(str, datum['coord']))  # Convert the coordinate tuple to a comma-separated string
-            xcoord, ycoord, zcoord = map(float, coord.split(','))  # Split the coordinate string and convert each part to a float
-            writer.writerow([format(numdate, '.6f'), strdate, format(xcoord, '.6f'), format(ycoord, '.6f'), format(zcoord, '.6f')])  # Write the refined data to the CSV file
+    Save the precession angles and the best fit slope to a JSON file.
+
+    Args:
+        data (list): The refined perihelia.
+        filename (str): The name of the output file.
+        comparison (list): The differences from compare, or None to leave them out.
+    """
+    (numdate, strdate, arcsec) = precess(data)  # Calculate the precession angles
+    (_, slope) = fit(numdate, arcsec) if len(numdate) > 1 else (None, None)
+    result = {'slope': slope,  # arcsec per century, null without two perihelia to fit
+              'perihelia': [{'numdate': float(n), 'strdate': str(d), 'coord': list(datum['coord']), 'arcsec': float(a)}
+                            for n, d, a, datum in zip(numdate, strdate, arcsec, data)]}
+    if comparison is not None:
+        result['comparison'] = comparison  # dt in minutes and dr in km against the per-date files
+    with open(filename + '.json', 'w') as file:
+        json.dump(result, file, indent=1)
+
 def loaddata(filename):
     """
     Load data from a text file.
@@ -90,31 +291,279 @@ def loaddata(filename):
     Returns:
         list: A list of dictionaries containing the loaded data.
     """
+    return cols2dicts(loadcolumns(filename))  # Parse the file into columns and convert each row into a dictionary
+
+def loadcolumns(filename, chunksize=1 << 20, cache=True):
+    """
+    Load data from a text file into columnar arrays, reusing a binary cache when it is up to date.
+
+    Args:
+        filename (str): The name of the file to load.
+        chunksize (int): The number of bytes to read at a time.
+        cache (bool): Whether to read and write the binary cache next to the file.
+
+    Returns:
+        dict: A dictionary with 'numdate' (float64, N), 'strdate' (bytes, N), 'coord' (float64, Nx3),
+        'year' (int32, N) and 'month' (int8, N, 1 for January) arrays.
+    """
     if filename == 'horizons_results':
         filename = filename + '.txt'  # Add the file extension if it is not present
-    file = open(filename,'r')  # Open the file for reading
-    lines = file.readlines()  # Read all lines from the file
-    file.close()  # Close the file
+    if not cache:
+        return parsecolumns(filename, chunksize)
+    key = cachekey(filename)  # Path, size and modification time of the source
+    data = readcache(filename, key, chunksize)
+    if data is None:
+        data = parsecolumns(filename, chunksize)  # Parse the text and store the columns for next time
+        key['sha1'] = filehash(filename, chunksize)
+        writecache(filename, key, data)
+    return data
+
+def loadmany(filenames, workers=None):
+    """
+    Load several text files into columnar arrays using a pool of processes.
+
+    Args:
+        filenames (list): The names of the files to load.
+        workers (int): The number of processes, or None for one per core.
+
+    Returns:
+        list: The columns of each file in input order, or None for files that could not be loaded.
+    """
+    if workers == 1 or len(filenames) <= 1:
+        results = [loadsafe(filename) for filename in filenames]  # Not worth starting a pool
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(loadsafe, filenames))  # map keeps the input order
+    data = []
+    for filename, (columns, error) in zip(filenames, results):
+        if error is not None:
+            print(filename,":",error)  # Report the failure without aborting the other files
+        data.append(columns)
+    return data
+
+def loadsafe(filename):
+    """
+    Load a text file into columnar arrays, catching any error.
+
+    Args:
+        filename (str): The name of the file to load.
+
+    Returns:
+        tuple: The columns and None, or None and the error message.
+    """
+    try:
+        return (loadcolumns(filename), None)
+    except Exception as error:
+        return (None, repr(error))
+
+def cachekey(filename):
+    """
+    Describe a source file for the cache.
+
+    Args:
+        filename (str): The name of the source file.
+
+    Returns:
+        dict: The absolute path, size and modification time of the file.
+    """
+    info = os.stat(filename)
+    return {'path': os.path.abspath(filename), 'size': info.st_size, 'mtime': info.st_mtime_ns}
+
+def filehash(filename, chunksize=1 << 20):
+    """
+    Compute the SHA-1 hash of a file, reading it in fixed-size chunks.
+
+    Args:
+        filename (str): The name of the file to hash.
+        chunksize (int): The number of bytes to read at a time.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunksize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def readcache(filename, key, chunksize=1 << 20):
+    """
+    Load the cached columns of a file if they still match the file.
+
+    The path, size and modification time are compared first; if any differ,
+    the content hash decides, so touching or moving an unchanged file does not
+    force a re-parse.
+
+    Args:
+        filename (str): The name of the source file.
+        key (dict): The current key from cachekey.
+        chunksize (int): The number of bytes to read at a time when hashing.
+
+    Returns:
+        dict: The cached columns, or None if there is no valid cache.
+    """
+    try:
+        with np.load(filename + '.cache.npz') as cached:
+            stored = json.loads(str(cached['key']))
+            data = {name: cached[name] for name in ('numdate', 'strdate', 'coord', 'year', 'month')}
+    except (OSError, KeyError, ValueError, EOFError, zipfile.BadZipFile):
+        return None  # Missing, unreadable or truncated cache, parsed again and rewritten
+    if any(stored.get(name) != value for name, value in key.items()):
+        if stored.get('size') != key['size'] or stored.get('sha1') != filehash(filename, chunksize):
+            return None  # The source changed since the cache was written
+        key['sha1'] = stored['sha1']
+        writecache(filename, key, data)  # Same content, refresh the path and modification time
+    print(filename,":",len(data['numdate']),"line(s) from cache")
+    return data
+
+def writecache(filename, key, data):
+    """
+    Store the columns of a file in a binary cache next to it.
+
+    Args:
+        filename (str): The name of the source file.
+        key (dict): The key from cachekey, including the content hash.
+        data (dict): The columns to store.
+    """
+    target = filename + '.cache.npz'
+    temp = '%s.%d.tmp' % (target, os.getpid())  # Unique per process, so concurrent runs never share it
+    try:
+        with open(temp, 'wb') as file:
+            np.savez(file, key=json.dumps(key), **data)
+        os.replace(temp, target)  # Replace the old cache in one step
+    except OSError:
+        print(filename,": could not write cache")
+        if os.path.exists(temp):
+            os.remove(temp)
+
+def parsecolumns(filename, chunksize=1 << 20):
+    """
+    Load data from a text file into columnar arrays, reading it in fixed-size chunks.
+
+    Args:
+        filename (str): The name of the file to load.
+        chunksize (int): The number of bytes to read at a time.
+
+    Returns:
+        dict: A dictionary with 'numdate' (float64, N), 'strdate' (bytes, N), 'coord' (float64, Nx3),
+        'year' (int32, N) and 'month' (int8, N, 1 for January) arrays.
+    """
     noSOE = True  # Flag to indicate if the start of the data section has been reached
     num = 0  # Counter for the number of lines read
-    data = []  # List to store the loaded data
-    for line in lines:
-        if noSOE:
-            if line.rstrip() == "$$SOE":  # Check if the start of the data section is reached
+    blocks = []  # List to store the columns parsed from each chunk
+    tail = b''  # Partial line carried over from the previous chunk
+    with open(filename, 'rb') as file:
+        while True:
+            chunk = file.read(chunksize)  # Read the next fixed-size chunk
+            buf = tail + chunk
+            if noSOE:
+                start = findmarker(buf, b'$$SOE')  # Look for the start of the data section
+                if start < 0:
+                    tail = buf[buf.rfind(b'\n')+1:]  # Keep only the partial last line
+                    if not chunk:
+                        break  # End of file without a $$SOE line
+                    continue
                 noSOE = False  # Set the flag to false to indicate the start of the data section
-        elif line.rstrip() != "$$EOE":  # Check if the end of the data section is reached
-            num = num+1  # Increment the line counter
-            if num % 10000 == 0:
-                print(filename,":",num,"line(s)")  # Print the progress every 10000 lines
-            datum = str2dict(line)  # Convert the line of text into a dictionary
-            data.append(datum)  # Add the dictionary to the data list
-        else:
-            break  # Exit the loop if the end of the data section is reached
+                buf = buf[start:]
+            end = findmarker(buf, b'$$EOE')  # Look for the end of the data section
+            last = end >= 0 or not chunk  # Flag to indicate the final chunk of the data section
+            if last:
+                body, tail = (buf[:end] if end >= 0 else buf), b''
+            else:
+                cut = buf.rfind(b'\n')+1  # Parse complete lines only
+                body, tail = buf[:cut], buf[cut:]
+            cols = chunk2cols(body)  # Convert the complete lines into columns
+            if len(cols['numdate']):
+                blocks.append(cols)  # Add the columns to the list
+                num = num+len(cols['numdate'])  # Increment the line counter
+                if not last:
+                    print(filename,":",num,"line(s)")  # Print the progress after every chunk
+            if last:
+                break  # Exit the loop if the end of the data section is reached
     if noSOE:
         print(filename,": no $$SOE line")  # Print a message if the start of the data section is not found
     else:
         print(filename,":",num,"line(s)")  # Print the total number of lines read
-    return data  # Return the loaded data
+    if not blocks:
+        blocks.append(chunk2cols(b''))  # Empty columns with the right shapes
+    return {key: np.concatenate([cols[key] for cols in blocks]) for key in blocks[0]}  # Return the loaded columns
+
+def findmarker(buf, marker):
+    """
+    Find a marker line such as $$SOE or $$EOE in a buffer.
+
+    Args:
+        buf (bytes): The buffer to search.
+        marker (bytes): The marker to look for.
+
+    Returns:
+        int: The offset just past the marker line for $$SOE, the offset of the marker line for
+        any other marker, or -1 if the complete marker line is not in the buffer.
+    """
+    pos = buf.find(marker)
+    while pos >= 0:
+        eol = buf.find(b'\n', pos)  # End of the line containing the marker
+        if (pos == 0 or buf[pos-1:pos] == b'\n') and (eol >= 0 or marker == b'$$EOE'):
+            line = buf[pos:eol] if eol >= 0 else buf[pos:]
+            if line.rstrip() == marker:  # Check that the marker is the whole line
+                return eol+1 if marker == b'$$SOE' else pos
+        pos = buf.find(marker, pos+1)
+    return -1
+
+def chunk2cols(body):
+    """
+    Convert a block of complete data lines into columns.
+
+    Args:
+        body (bytes): The lines of text to convert.
+
+    Returns:
+        dict: A dictionary with 'numdate', 'strdate', 'coord', 'year' and 'month' arrays for the block.
+    """
+    lines = body.replace(b'\r', b'').strip(b'\n')  # Drop carriage returns and surrounding blank lines
+    if not lines:
+        strdate = np.empty(0, 'S11')
+        return {'numdate': np.empty(0), 'strdate': strdate, 'coord': np.empty((0, 3)), **datecols(strdate)}
+    fields = np.array(lines.replace(b'\n', b'').split(b',')[:-1])  # Every line ends with a comma, so joined lines split into 5 fields per row
+    fields = fields.reshape(-1, 5)  # One row per line: numdate, calendar date, X, Y, Z
+    numdate = fields[:, 0].astype(np.float64)  # Convert the first column to floats
+    coord = fields[:, 2:].astype(np.float64)  # Convert the coordinate columns to floats
+    date = np.ascontiguousarray(fields[:, 1])  # Calendar date column, e.g. b' A.D. 1800-Mar-20 00:00:00.0000'
+    width = date.dtype.itemsize
+    strdate = date.view(np.uint8).reshape(-1, width)[:, 6:17].copy().view('S11').ravel()  # Same characters as parts[1][6:17]
+    return {'numdate': numdate, 'strdate': strdate, 'coord': coord, **datecols(strdate)}
+
+def datecols(strdate):
+    """
+    Compute the year and month columns of an array of date strings.
+
+    Args:
+        strdate (numpy.ndarray): The dates as bytes, e.g. b'1800-Mar-21'.
+
+    Returns:
+        dict: A dictionary with 'year' (int32) and 'month' (int8, 1 for January) arrays.
+    """
+    chars = np.asarray(strdate, 'S11').view(np.uint8).reshape(-1, 11)
+    year = (chars[:, 0:4].astype(np.int32)-ord('0')) @ np.array([1000, 100, 10, 1], np.int32)  # Digits of the year
+    code = chars[:, 5:8].astype(np.int32) @ np.array([65536, 256, 1], np.int32)  # Month name as one integer
+    names = np.array([ord(m[0])*65536+ord(m[1])*256+ord(m[2]) for m in MONTHS], np.int32)
+    order = np.argsort(names)
+    pos = np.searchsorted(names, code, sorter=order).clip(0, 11)
+    month = np.where(names[order[pos]] == code, order[pos]+1, 0).astype(np.int8)  # 0 if the name is not a month
+    return {'year': year, 'month': month}
+
+def cols2dicts(data):
+    """
+    Convert columnar data into a list of dictionaries.
+
+    Args:
+        data (dict): The columns returned by loadcolumns.
+
+    Returns:
+        list: A list of dictionaries, one per row, in the format returned by str2dict.
+    """
+    return [{'numdate': float(numdate), 'strdate': strdate.decode(), 'coord': tuple(map(float, coord))}
+            for numdate, strdate, coord in zip(data['numdate'], data['strdate'], data['coord'])]
 
 def str2dict(line):
     """
@@ -137,83 +586,185 @@ def locate(data1):
     Locate the perihelia in the data.
 
     Args:
-        data1 (list): The input data.
+        data1 (dict or list): The input data, as columns from loadcolumns or as a list of dictionaries.
 
     Returns:
-        list: A list of dictionaries containing the located perihelia.
+        dict or list: The located perihelia, in the same form as the input data.
     """
-    dist = []  # List to store the vector lengths
-    for datum in data1:
-        coord = np.array(datum['coord'])  # Convert the coordinate tuple to a numpy array
-        dot = np.dot(coord,coord)  # Calculate the dot product of the coordinate array with itself
-        dist.append(np.sqrt(dot))  # Calculate the vector length and add it to the list
-    data2 = []  # List to store the located perihelia
-    for k in range(1,len(dist)-1):
-        if dist[k] < dist[k-1] and dist[k] < dist[k+1]:  # Check if the current distance is smaller than the previous and next distances
-            data2.append(data1[k])  # Add the corresponding datum to the located perihelia list
-    return data2  # Return the located perihelia
+    if isinstance(data1, dict):
+        return take(data1, perihelia(data1['coord']))  # Slice every column at the perihelion rows
+    coord = np.array([datum['coord'] for datum in data1]).reshape(-1, 3)  # Stack the coordinate tuples into an Nx3 array
+    return [data1[k] for k in perihelia(coord)]  # Return the located perihelia
 
-def select(data, ystep, month):
+def perihelia(coord):
+    """
+    Find the perihelia in an array of coordinates.
+
+    Args:
+        coord (numpy.ndarray): The Nx3 array of coordinates.
+
+    Returns:
+        numpy.ndarray: The indices of the strict local minima of the distance from the Sun.
+    """
+    dist = np.sqrt(np.einsum('ij,ij->i', coord, coord))  # Calculate all vector lengths at once
+    inner = dist[1:-1]
+    minima = (inner < dist[:-2]) & (inner < dist[2:])  # Check if each distance is smaller than the previous and next distances
+    return np.flatnonzero(minima)+1  # Shift back to indices into the full array
+
+def take(data, index):
+    """
+    Select rows from columnar data.
+
+    Args:
+        data (dict): The columns returned by loadcolumns.
+        index (numpy.ndarray): The row indices or boolean mask to keep.
+
+    Returns:
+        dict: The columns restricted to the selected rows.
+    """
+    return {key: column[index] for key, column in data.items()}
+
+def select(data, ystep, month, start=None, stop=None, where=None):
     """
     Select data based on year and month.
 
     Args:
-        data (list): The input data.
-        ystep (int): The year step.
-        month (tuple): The months to select.
+        data (dict or list): The input data, as columns or as a list of dictionaries.
+        ystep (int): The year step, or None to keep every year.
+        month (tuple): The months to select, or None to keep every month.
+        start (float): The first numerical date to keep, or None.
+        stop (float): The numerical date to stop before, or None.
+        where (function): A further predicate taking the columns and returning a boolean mask, or None.
+
+    Returns:
+        dict or list: The selected data, in the same form as the input data.
+    """
+    if isinstance(data, dict):
+        return take(data, selectmask(data, ystep, month, start, stop, where))  # Filter the precomputed columns
+    numdate = np.array([datum['numdate'] for datum in data])
+    strdate = np.array([datum['strdate'] for datum in data], 'S11')
+    cols = {'numdate': numdate, 'strdate': strdate, **datecols(strdate)}  # Index the dictionaries once
+    mask = selectmask(cols, ystep, month, start, stop, where)
+    return [datum for datum, keep in zip(data, mask) if keep]  # Return the selected data
+
+def monthnumbers(month):
+    """
+    Convert month names to month numbers.
+
+    Args:
+        month (tuple): The month names, e.g. ('Jan', 'Feb'); surrounding whitespace is ignored.
+
+    Returns:
+        list: The month numbers, 1 for January.
+
+    Raises:
+        ValueError: If a name is not one of MONTHS.
+    """
+    numbers = []
+    for m in month:
+        if m.strip() not in MONTHS:
+            raise ValueError("unknown month %r, expected one of %s" % (m, ', '.join(MONTHS)))
+        numbers.append(MONTHS.index(m.strip())+1)
+    return numbers
+
+def selectmask(data, ystep, month, start=None, stop=None, where=None):
+    """
+    Compute the boolean mask of the rows kept by select.
+
+    Args:
+        data (dict): The columns, including 'year' and 'month'.
+        ystep (int): The year step, or None to keep every year.
+        month (tuple): The months to select, or None to keep every month.
+        start (float): The first numerical date to keep, or None.
+        stop (float): The numerical date to stop before, or None.
+        where (function): A further predicate taking the columns and returning a boolean mask, or None.
 
     Returns:
-        list: A list of dictionaries containing the selected data.
+        numpy.ndarray: True for the rows to keep.
     """
-    selected_data = []  # List to store the selected data
-    for datum in data:
-        year = int((datum['strdate'].split('-')[0])[0:4])  # Extract the year from the date string
-        month_str = datum['strdate'].split('-')[1]  # Extract the month from the date string
-        if year % ystep == 0 and month_str in month:  # Check if the year is divisible by ystep and the month is in the specified list
-            selected_data.append(datum)  # Add the datum to the selected data list
-    return selected_data  # Return the selected data
+    mask = np.ones(len(data['numdate']), bool)
+    if ystep is not None:
+        mask &= data['year'] % ystep == 0  # Check if the year is divisible by ystep
+    if month is not None:
+        mask &= np.isin(data['month'], monthnumbers(month))  # Check if the month is in the specified list
+    if start is not None:
+        mask &= data['numdate'] >= start
+    if stop is not None:
+        mask &= data['numdate'] < stop
+    if where is not None:
+        mask &= where(data)
+    return mask
 
-def makeplot(data, filename):
+def makeplot(data, filename, show=True):
     """
     Make a plot of the data.
 
     Args:
         data (list): The input data.
         filename (str): The name of the output file.
+        show (bool): Whether to display the plot, or only save it with the Agg backend.
     """
+    import matplotlib  # Imported here so that batch runs without plots never load it
+    if not show:
+        matplotlib.use('Agg')  # Non-interactive backend
+    import matplotlib.pyplot as plt
     (numdate, strdate, arcsec) = precess(data)  # Calculate the precession angles
     plt.plot(numdate, arcsec, 'bo')  # Plot the precession angles
-    strdate = [datum['strdate'] for datum in data]  # Extract the date strings from the data
     plt.xticks(numdate, strdate, rotation=45)  # Set the x-axis ticks to the date strings
     add2plot(numdate, arcsec)  # Add the best fit line to the plot
     plt.xlabel('Perihelion date')  # Set the x-axis label
     plt.ylabel('Precession (arcsec)')  # Set the y-axis label
     plt.savefig(filename+'.png', bbox_inches='tight')  # Save the plot to a file
-    plt.show()  # Display the plot
+    if show:
+        plt.show()  # Display the plot
+    else:
+        plt.close()  # Free the figure for the next run
 
 def precess(data):
-    numdate = []  # List to store the numerical dates
-    strdate = []  # List to store the date strings
-    arcsec = []  # List to store the precession angles
-    v = np.array(data[0]['coord'])  # Reference (3D) coordinate array
-    for datum in data:
-        u = np.array(datum['coord'])  # Perihelion (3D) coordinate array
-        ratio = np.dot(u,v)/np.sqrt(np.dot(u,u)*np.dot(v,v))  # Calculate the dot product ratio
-        if np.abs(ratio) <= 1:  # Check if the ratio is within the valid range
-            angle = 3600*np.degrees(np.arccos(ratio))  # Calculate the precession angle in arcseconds
-            numdate.append(datum['numdate'])  # Add the numerical date to the list
-            strdate.append(datum['strdate'])  # Add the date string to the list
-            arcsec.append(angle)  # Add the precession angle to the list
+    """
+    Calculate the precession angle of each perihelion relative to the first one.
+
+    Args:
+        data (dict or list): The perihelia, as columns or as a list of dictionaries.
+
+    Returns:
+        tuple: Arrays of the numerical dates, date strings and precession angles in arcseconds.
+    """
+    if isinstance(data, dict):
+        numdate, strdate, u = data['numdate'], data['strdate'].astype(str), data['coord']
+    else:
+        numdate = np.array([datum['numdate'] for datum in data])  # Numerical dates
+        strdate = np.array([datum['strdate'] for datum in data])  # Date strings
+        u = np.array([datum['coord'] for datum in data]).reshape(-1, 3)  # Perihelion (3D) coordinate arrays
+    if len(u) == 0:
+        return (numdate, strdate, np.zeros(0))  # Nothing was refined, e.g. every per-date file failed to load
+    v = u[0]  # Reference (3D) coordinate array
+    cross = np.linalg.norm(np.cross(u, v), axis=1)  # |u x v| for every perihelion at once
+    dot = u @ v  # u . v for every perihelion at once
+    arcsec = 3600*np.degrees(np.arctan2(cross, dot))  # Stable near zero, unlike arccos of the ratio
     return (numdate, strdate, arcsec)  # Return the numerical dates, date strings, and precession angles
 
-def add2plot(numdate, actual):
+def fit(numdate, actual):
+    """
+    Fit a line to the precession angles.
+
+    Args:
+        numdate (numpy.ndarray): The numerical dates.
+        actual (numpy.ndarray): The precession angles in arcseconds.
+
+    Returns:
+        tuple: The linear regression result and its slope in arcseconds per century.
+    """
     r = stats.linregress(numdate, actual)  # Perform linear regression on the data
-    bestfit = []  # List to store the best fit line
-    for k in range(len(numdate)):
-        bestfit.append(r[0]*numdate[k]+r[1])  # Calculate the best fit line values
+    return (r, r[0] * 365.25 * 100)
+
+def add2plot(numdate, actual):
+    import matplotlib.pyplot as plt
+    (r, slope) = fit(numdate, actual)  # Perform linear regression on the data
+    bestfit = r[0]*np.asarray(numdate)+r[1]  # Calculate the best fit line values
     plt.plot(numdate, bestfit, 'b-')  # Plot the best fit line
-    slope = r[0] * 365.25 * 100 # Calculate the slope in arcsecs/year
     plt.title(f"Slope of the best fit line: {slope:.2f} arcsec/cent")  # Set the title of the plot with the slope of the best fit line
     plt.legend(["Actual data", "Best fit line"], loc="upper left")  # Add a legend to the plot
 
-main()  # Call the main function to start the program
+if __name__ == '__main__':
+    main()  # Call the main function to start the program, but not in the worker processes
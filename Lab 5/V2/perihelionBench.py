@@ -0,0 +1,174 @@
+## PERIHELIONBENCH  Benchmark the perihelion precession pipeline
+#
+# Generates synthetic Horizons ephemerides of a precessing Keplerian orbit,
+# times each stage of lab5V2_jaskara8.py on them and checks that the
+# recovered precession rate matches the injected one. Results are written
+# to a JSON file so that runs can be compared for regressions.
+#
+# Copyright (c) 2022, University of Alberta
+# Electrical and Computer Engineering
+# All rights reserved.
+#
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import lab5V2_jaskara8 as lab5
+
+def main(argv=None):
+    """
+    Run the benchmark for each requested number of rows and save the results.
+
+    Args:
+        argv (list): The command line arguments, or None to use sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the perihelion precession pipeline")
+    parser.add_argument('--rows', default='100000,1000000', help="comma-separated numbers of rows, e.g. 1e5,1e6,1e7")
+    parser.add_argument('--years', type=float, default=300, help="time span of each synthetic file in years")
+    parser.add_argument('--rate', type=float, default=575.31, help="injected precession in arcsec per century")
+    parser.add_argument('--tolerance', type=float, default=1.0, help="largest accepted error of the recovered rate in arcsec per century")
+    parser.add_argument('--dictlimit', type=float, default=1e6, help="largest file timed with the list-of-dictionaries path")
+    parser.add_argument('--dir', default=None, help="directory for the synthetic files, a temporary one by default")
+    parser.add_argument('--output', default='perihelion_bench.json', help="name of the results file")
+    parser.add_argument('--nomemory', action='store_true', help="skip the peak memory measurements")
+    args = parser.parse_args(argv)
+    folder = args.dir or tempfile.mkdtemp(prefix='perihelion_')
+    os.makedirs(folder, exist_ok=True)
+    results = []
+    for rows in (int(float(n)) for n in args.rows.split(',')):
+        filename = os.path.join(folder, 'synthetic_%d.txt' % rows)
+        step = args.years*365.25/rows  # Step in days so that the file spans the requested years
+        if not os.path.exists(filename):
+            generate(filename, rows, step, args.rate)
+        result = benchmark(filename, args.rate, rows <= args.dictlimit, not args.nomemory)
+        passed = bool(abs(result['recovered']-result['injected']) <= args.tolerance)  # False for a NaN rate too
+        result.update({'rows': rows, 'step': step, 'bytes': os.path.getsize(filename), 'tolerance': args.tolerance, 'passed': passed})
+        results.append(result)
+        print(rows, "row(s):", "%.2f" % result['recovered'], "arcsec/cent recovered,", "%.2f" % result['injected'], "injected,",
+              "ok" if passed else "FAILED")
+        for stage in result['stages']:
+            print("  %-16s %9.3f s %12.0f rows/s %10.1f MB" % (stage['stage'], stage['seconds'], stage['rate'], stage['peak']/2**20))
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    failed = [result['rows'] for result in results if not result['passed']]
+    if failed:
+        raise SystemExit("Recovered rate off by more than %g arcsec/cent for %s row(s)" % (args.tolerance, ', '.join(map(str, failed))))
+
+def generate(filename, rows, step, rate, chunk=1000000):
+    """
+    Write a synthetic Horizons file for Mercury on a Keplerian orbit with a precessing perihelion.
+
+    Args:
+        filename (str): The name of the file to write.
+        rows (int): The number of data lines.
+        step (float): The time step in days.
+        rate (float): The precession of the argument of perihelion in arcsec per century.
+        chunk (int): The number of lines formatted at a time.
+    """
+    (a, e, period) = (5.7909e7, 0.205630, 87.9691)  # Semi-major axis (km), eccentricity and period (days)
+    (incl, node, peri) = np.radians((7.005, 48.331, 29.124))  # Inclination, ascending node and argument of perihelion
+    epoch = 2451545.0  # J2000.0
+    start = epoch-step*rows/2  # Centre the file on J2000.0
+    row = '{:.9f}, A.D. {} {:02d}:{:02d}:{:07.4f}, {:22.15E}, {:22.15E}, {:22.15E},\n'.format
+    with open(filename, 'w') as file:
+        file.write("Synthetic ephemeris: Mercury (199) around the Sun (10), %.6g arcsec/cent\n" % rate)
+        file.write("            JDTDB,            Calendar Date (TDB),                      X,                      Y,                      Z,\n")
+        file.write("$$SOE\n")
+        for first in range(0, rows, chunk):
+            t = start+step*np.arange(first, min(first+chunk, rows))
+            mean = 2*np.pi*(t-epoch)/period
+            ecc = mean.copy()
+            for _ in range(8):
+                ecc -= (ecc-e*np.sin(ecc)-mean)/(1-e*np.cos(ecc))  # Newton's method for Kepler's equation
+            x = a*(np.cos(ecc)-e)  # Position in the orbital plane, perihelion along x
+            y = a*np.sqrt(1-e*e)*np.sin(ecc)
+            w = peri+np.radians(rate/3600)*(t-epoch)/36525  # Precessing argument of perihelion
+            (xw, yw) = (x*np.cos(w)-y*np.sin(w), x*np.sin(w)+y*np.cos(w))
+            (xi, zi) = (xw, yw*np.sin(incl))
+            yi = yw*np.cos(incl)
+            coord = (xi*np.cos(node)-yi*np.sin(node), xi*np.sin(node)+yi*np.cos(node), zi)  # Ecliptic frame
+            seconds = np.round(((t+0.5) % 1)*86400, 4)
+            strdate = np.char.decode(lab5.jd2str(t))
+            file.write(''.join(map(row, t.tolist(), strdate, (seconds//3600).astype(int).tolist(),
+                                   (seconds % 3600//60).astype(int).tolist(), (seconds % 60).tolist(),
+                                   *(c.tolist() for c in coord))))
+        file.write("$$EOE\n")
+
+def measure(memory, func, *args):
+    """
+    Time a call and optionally measure its peak memory in a second call.
+
+    Args:
+        memory (bool): Whether to measure the peak memory.
+        func (function): The function to call.
+        args: The arguments of the function.
+
+    Returns:
+        tuple: The result, the time in seconds and the peak traced memory in bytes.
+    """
+    with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet):  # Silence the progress messages
+        begin = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter()-begin
+        peak = 0
+        if memory:
+            tracemalloc.start()  # Traced separately so the timing does not include the tracing overhead
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return (result, seconds, peak)
+
+def benchmark(filename, rate, dicts=True, memory=True):
+    """
+    Time each stage of the pipeline on one file and recover the precession rate.
+
+    Args:
+        filename (str): The name of the synthetic file.
+        rate (float): The injected precession in arcsec per century.
+        dicts (bool): Whether to also time the list-of-dictionaries path.
+        memory (bool): Whether to measure the peak memory of each stage.
+
+    Returns:
+        dict: The stages with their times, throughputs and peak memory, and the injected and recovered rates.
+    """
+    import matplotlib
+    matplotlib.use('Agg')  # Plot stages without a display
+    import matplotlib.pyplot as plt
+    cache = filename+'.cache.npz'
+    if os.path.exists(cache):
+        os.remove(cache)  # Start from the text every time
+    stages = []
+    def record(stage, rows, func, *args):
+        (result, seconds, peak) = measure(memory, func, *args)
+        stages.append({'stage': stage, 'rows': rows, 'seconds': seconds, 'peak': peak})
+        return result
+    source = record('loadcolumns', None, lab5.loadcolumns, filename, 1 << 20, False)
+    rows = len(source['numdate'])
+    stages[0]['rows'] = rows
+    measure(False, lab5.loadcolumns, filename)  # Write the cache
+    record('cache', rows, lab5.loadcolumns, filename)
+    if dicts:
+        data = record('loaddata', rows, lab5.loaddata, filename)
+        with open(filename) as file:
+            lines = [line for line in file if line[:1].isdigit()]
+        record('str2dict', len(lines), lambda: [lab5.str2dict(line) for line in lines])
+        del data, lines
+    perihelia = record('locate', rows, lab5.locate, source)
+    count = len(perihelia['numdate'])
+    record('select', count, lab5.select, perihelia, 50, ('Jan', 'Feb', 'Mar'))
+    refined = record('refine', count, lab5.interpolate, lab5.cols2dicts(perihelia), source)
+    (numdate, strdate, arcsec) = record('precess', count, lab5.precess, refined)
+    record('add2plot', count, lambda: (lab5.add2plot(numdate, arcsec), plt.close()))
+    (_, slope) = lab5.fit(numdate, arcsec)
+    for stage in stages:
+        stage['rate'] = stage['rows']/stage['seconds'] if stage['seconds'] else float('inf')  # Rows per second
+    return {'stages': stages, 'injected': rate, 'recovered': slope}
+
+if __name__ == '__main__':
+    main()
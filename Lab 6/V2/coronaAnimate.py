@@ -3,16 +3,22 @@
 # A simulation of a coronagraph and the Gerchberg-Saxton algorithm, in the
 # context of NASA's Roman Space Telescope, developed to help teach ENCMP
 # 100 Computer Programming for Engineers at the University of Alberta. The
-# program loads images from PNG files and produces an AVI video file.
+# program loads images from PNG files and produces an AVI video file. The
+# simulation can also write the video directly (see VideoSink), or from a
+# frame archive (see --from-archive), in which case this step is not needed.
+# An optional argument gives the last frame number, e.g. python
+# coronaAnimate.py 10, so stale frames of a longer run are left out.
 #
 # Copyright (c) 2022, University of Alberta
 # Electrical and Computer Engineering
 # All rights reserved.
 #
+import sys
+
 import cv2
 
-lastNum = int(input("Last frame number? "))
 (prefix,suffix) = ('coronagraph','.png')
+last = int(sys.argv[1]) if len(sys.argv) > 1 else None # (last frame number)
 image = cv2.imread(prefix+'0'+suffix)
 
 if image is not None:
@@ -22,11 +28,13 @@ if image is not None:
     video = cv2.VideoWriter(prefix+'.avi',code,fps,size)
     video.write(image)
 
-    for k in range(1,lastNum+1):
+    k = 1
+    while last is None or k <= last: # until the last or a missing frame number
         image = cv2.imread(prefix+str(k)+suffix)
         if image is not None:
             video.write(image)
+            k = k+1
         else:
-            break # for
+            break # while
 
     video.release()
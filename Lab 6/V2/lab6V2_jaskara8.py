@@ -26,41 +26,206 @@
 # followed by percentages as above. Email a link to or a copy of the
 # source to the lab instructor before the assignment is due.
 #
+import argparse
+import atexit
+import bz2
+import csv
+import glob
+import hashlib
+import importlib.util
+import itertools
+import json
+import os
+import pickle
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from multiprocessing import shared_memory
 import numpy as np
 import matplotlib.pyplot as plt
 
-def main():
+def main(argv=None):
     """
     The main function that runs the simulation by initializing the class and invoking each function as required.
+
+    Parameters:
+    - argv (list): The command line arguments, or None to use sys.argv.
     """
-    im = loadImage('300_26a_big-vlt-s.jpg')
-    im, Dphi, mask = opticalSystem(im, 300)
-    images, errors = gerchbergSaxton(im, 10, Dphi, mask)
-    saveFrames(images, errors)
+    parser = argparse.ArgumentParser(description="Coronagraph and Gerchberg-Saxton simulation")
+    parser.add_argument('--fft', default=None, choices=FFT_BACKENDS, help="FFT backend, autodetected by default")
+    parser.add_argument('--workers', type=int, default=None, help="threads used by the FFT backend")
+    parser.add_argument('--check-fft', action='store_true', help="check that the available FFT backends agree, then exit")
+    parser.add_argument('--image', default='300_26a_big-vlt-s.jpg', help="image to simulate")
+    parser.add_argument('--roi', type=lambda text: tuple(int(n) for n in text.split(',')), default=None,
+                        help="region of --image to simulate as top,left,height,width")
+    parser.add_argument('--diameter', type=int, default=300, help="diameter of the occulting circle")
+    parser.add_argument('--iters', type=int, default=10, help="maximum number of iterations")
+    parser.add_argument('--solver', default='blend', choices=('blend', 'gs', 'hio', 'raar'),
+                        help="blend the phase towards the correction, or retrieve it by alternating projections")
+    parser.add_argument('--beta', type=float, default=0.9, help="feedback parameter of the hio and raar solvers")
+    parser.add_argument('--tol', type=float, default=1e-3, help="relative error improvement below which the solvers stop")
+    parser.add_argument('--video', default='coronagraph.avi' if importlib.util.find_spec('cv2') else '',
+                        help="AVI file to write, or an empty string for none; needs OpenCV, without which PNG files are saved instead")
+    parser.add_argument('--fps', type=int, default=10, help="frames per second of the video")
+    parser.add_argument('--png', action='store_true', help="also save each frame to coronagraphK.png")
+    parser.add_argument('--archive', default=None, help="also save the frames to a delta-encoded archive file")
+    parser.add_argument('--archive-store', default='rendered', choices=('rendered', 'uint8', 'uint16'),
+                        help="with --archive, store the rendered video frames, or the simulation frames at 8 or 16 bits")
+    parser.add_argument('--from-archive', metavar='ARCHIVE', default=None, help="encode --video from an archive file, then exit")
+    parser.add_argument('--show', action='store_true', help="display each frame")
+    parser.add_argument('--precision', default='double', choices=PRECISIONS, help="floating point precision of the simulation")
+    parser.add_argument('--precision-report', action='store_true', help="compare single and double precision errors, then exit")
+    parser.add_argument('--out-of-core', metavar='TARGET', default=None, help="process --image, a .npy file or a raw one with --shape, out of core into TARGET, then exit")
+    parser.add_argument('--alpha', type=float, default=None, help="with --out-of-core, also form the frame at this interpolation factor")
+    parser.add_argument('--scratch', default=None, help="with --out-of-core, directory for the scratch arrays")
+    parser.add_argument('--shape', type=lambda text: tuple(int(n) for n in text.split(',')), default=None,
+                        help="with --out-of-core, height,width of a raw --image that is not a .npy file")
+    parser.add_argument('--dtype', default='float64', choices=('float64', 'float32'), help="with --out-of-core, type of a raw --image")
+    parser.add_argument('--sweep', metavar='TABLE', default=None, help="run a parameter sweep into the CSV file TABLE, then exit")
+    parser.add_argument('--diameters', default=None, help="with --sweep, comma-separated occulter sizes (default --diameter)")
+    parser.add_argument('--kinds', default='circle', help="with --sweep, comma-separated occulters: circle, square")
+    parser.add_argument('--seeds', default='12345', help="with --sweep, comma-separated random phase seeds")
+    parser.add_argument('--iters-list', default=None, help="with --sweep, comma-separated iteration counts (default --iters)")
+    parser.add_argument('--processes', type=int, default=None, help="with --sweep, number of worker processes")
+    parser.add_argument('--batch', metavar='PATTERN', default=None, help="process every image matching a glob, or listed in a .txt manifest, then exit")
+    parser.add_argument('--batch-table', default='coronagraph_batch.csv', help="with --batch, CSV file of the error curves")
+    parser.add_argument('--threads', type=int, default=None, help="with --batch, number of worker threads")
+    parser.add_argument('--prefetch', type=int, default=4, help="with --batch, number of images decoded ahead")
+    args = parser.parse_args(argv)
+    setBackend(args.fft, args.workers)
+    if args.check_fft:
+        raise SystemExit(0 if checkBackends() else 1)
+    if args.precision_report:
+        precisionReport(args.image, args.diameter, args.iters)
+        return
+    if args.sweep:
+        ints = lambda text: [int(n) for n in text.split(',')]
+        try:
+            sweep(args.image, args.sweep, ints(args.diameters or str(args.diameter)), [kind.strip() for kind in args.kinds.split(',')],
+                  ints(args.seeds), ints(args.iters_list or str(args.iters)), args.processes, PRECISIONS[args.precision])
+        except ValueError as problem:
+            parser.error(str(problem))
+        return
+    if args.from_archive:
+        if not args.video:
+            parser.error("--from-archive needs --video, and OpenCV to write it")
+        with FrameArchive(args.from_archive) as archive:
+            render = (lambda frame, *plot: frame) if archive.rendered else None  # Rendered frames go to the video as they are
+            try:
+                sink = VideoSink(args.video, len(archive) - 1, args.fps, render)
+            except ImportError:
+                parser.error("--from-archive needs OpenCV to write the video")
+            streamFrames(archive, [sink])  # Decode one frame at a time
+        return
+    if args.batch:
+        batch(args.batch, args.batch_table, args.diameter, maxIters=args.iters, workers=args.threads,
+              prefetch=args.prefetch, dtype=PRECISIONS[args.precision])
+        return
+    if args.out_of_core:
+        try:
+            (_, error) = outOfCore(args.image, args.out_of_core, args.diameter, args.alpha, scratch=args.scratch,
+                                   shape=args.shape, dtype=np.dtype(args.dtype))
+        except ValueError as problem:
+            parser.error(str(problem))
+        print("Occultation error %g" % error)
+        return
+    im = loadImage(args.image, PRECISIONS[args.precision], args.roi)
+    im, Dphi, mask = opticalSystem(im, args.diameter)
+    if args.solver == 'blend':
+        frames = gsFrames(im, args.iters, Dphi, mask)  # Frames are generated one block at a time
+    else:
+        frames = phaseRetrieval(im, mask, args.iters, args.solver, args.beta, args.tol)
+    sinks = []
+    if args.video:
+        try:
+            sinks.append(VideoSink(args.video, args.iters, args.fps))  # Encode each frame without a PNG round trip
+        except ImportError:
+            print("OpenCV is not installed, saving PNG files instead of " + args.video, file=sys.stderr)
+            args.png = True
+    elif not (args.png or args.show or args.archive):
+        args.png = True  # Without OpenCV, save the frames as PNG files as before
+    if args.png or args.show:
+        sinks.append(PngSink(args.iters, show=args.show, render=FrameRenderer()))
+    if args.archive:
+        if args.archive_store == 'rendered':
+            sinks.append(ArchiveSink(args.archive, args.iters, FrameRenderer()))
+        else:
+            sinks.append(ArchiveSink(args.archive, dtype=np.dtype(args.archive_store)))
+    streamFrames(frames, sinks)  # Hand each frame to the sinks as soon as it is ready
+
+PRECISIONS = {'double': np.float64, 'single': np.float32}  # Image types; spectra are complex128 or complex64
 
-def loadImage(name):
+def loadImage(name, dtype=np.float64, roi=None):
     """
     Load the image used by the system, and preprocess it.
 
     Parameters:
     - name (str): The name of the image file.
+    - dtype (numpy.dtype): np.float64, or np.float32 to run the whole simulation in single precision.
+    - roi (tuple): The (top, left, height, width) region to keep, or None for the whole image.
 
     Returns:
     - numpy.ndarray: The preprocessed image.
     """
-    # Load the image
-    im = plt.imread(name)/255
+    # Load the image, keeping its integer pixels
+    raw = readImage(name)
     
-    # Convert to grayscale if necessary
-    if len(im.shape) > 2:
-        im = (im[:,:,0]+im[:,:,1]+im[:,:,2])/3
+    # Crop to the region of interest before any conversion
+    if roi is not None:
+        (top, left, height, width) = roi
+        raw = raw[top:top+height, left:left+width]
+    
+    # Integer pixels are scaled by their range, so the result is already in [0, 1]
+    integer = np.issubdtype(raw.dtype, np.integer)
+    scale = np.iinfo(raw.dtype).max if integer else 1
+    
+    # Convert to grayscale if necessary, summing the channels in integers
+    if raw.ndim > 2:
+        if raw.dtype == np.uint8:
+            total = np.add(raw[:,:,0], raw[:,:,1], dtype=np.uint16)  # At most 3*255, no overflow
+            total += raw[:,:,2]
+        elif integer:
+            total = np.add(raw[:,:,0], raw[:,:,1], dtype=np.int64)  # Also holds signed pixels
+            total += raw[:,:,2]
+        else:
+            total = np.tensordot(raw[:,:,:3], np.ones(3, raw.dtype), axes=1)
+        (raw, scale) = (total, 3 * scale)
     
-    # Clip pixel values to the range [0, 1]
-    im[im < 0] = 0
-    im[im > 1] = 1
+    # Scale to the final type in one allocation
+    im = np.divide(raw, scale, dtype=dtype)
+    
+    # Clip pixel values to the range [0, 1], only needed for floating point files
+    if not integer:
+        np.clip(im, 0, 1, out=im)
     
     return im
 
+def readImage(name):
+    """
+    Decode an image file with OpenCV when it is installed, or else with Matplotlib. The
+    order of the colour channels is not kept, since only their sum is used.
+
+    Parameters:
+    - name (str): The name of the image file.
+
+    Returns:
+    - numpy.ndarray: The decoded pixels, integers for most formats.
+    """
+    try:
+        import cv2  # Faster than Matplotlib for large JPEG and TIFF files
+    except ImportError:
+        cv2 = None
+    if cv2 is not None:
+        raw = cv2.imread(name, cv2.IMREAD_UNCHANGED)
+        if raw is not None:
+            return raw
+    return plt.imread(name)  # Formats OpenCV cannot read, and the errors of missing or broken files
+
 def occultCircle(im, diameter):
     """
     Occults a circle region in the given image.
@@ -73,34 +238,86 @@ def occultCircle(im, diameter):
     - numpy.ndarray: The image with the circle region occulted.
     - numpy.ndarray: The mask indicating the occulted pixels.
     """
+    # Create a mask that identifies the pixels within the circle, or reuse a cached one
+    mask = occultMask(im.shape, diameter, 'circle')
+
+    # Set the pixels within the circle to 0 (black)
+    im[mask] = 0
+
+    # Return the modified image and the mask
+    return im, mask
+
+def occultSquare(im, width):
+    """
+    Occults a square region in the given image.
+
+    Parameters:
+    - im (numpy.ndarray): The input image.
+    - width (int): The width of the square region to be occulted.
+
+    Returns:
+    - numpy.ndarray: The image with the square region occulted.
+    - numpy.ndarray: The mask indicating the occulted pixels.
+    """
+    mask = occultMask(im.shape, width, 'square')
+    im[mask] = 0
+    return im, mask
+
+def circleMask(shape, diameter, start=0, stop=None):
+    """
+    Compute the mask of a circle at the center of an image, or of a band of its rows.
+
+    Parameters:
+    - shape (tuple): The shape of the whole image.
+    - diameter (int): The diameter of the circle.
+    - start (int): The first row of the band.
+    - stop (int): The row after the band, or None for the last row.
+
+    Returns:
+    - numpy.ndarray: True for the pixels within the circle.
+    """
     # Define the center of the image
-    h, w = im.shape
+    h, w = shape
     center_h = h // 2
     center_w = w // 2
 
     # Calculate the radius of the circle
     radius = diameter // 2
 
-    # Create a grid of coordinates for the image
-    y, x = np.ogrid[:h, :w]
+    # Create a grid of coordinates for the rows
+    y, x = np.ogrid[start:h if stop is None else stop, :w]
 
-    # Create a mask that identifies the pixels within the circle
-    mask = (x - center_w)**2 + (y - center_h)**2 <= radius**2
+    return (x - center_w)**2 + (y - center_h)**2 <= radius**2
 
-    # Set the pixels within the circle to 0 (black)
-    im[mask] = 0
+def squareMask(shape, width):
+    """
+    Compute the mask of a square at the center of an image.
 
-    # Return the modified image and the mask
-    return im, mask
+    Parameters:
+    - shape (tuple): The shape of the image.
+    - width (int): The width of the square.
+
+    Returns:
+    - numpy.ndarray: True for the pixels within the square.
+    """
+    h, w = shape
+    start_h = h // 2 - width // 2
+    start_w = w // 2 - width // 2
+    mask = np.zeros(shape, bool)
+    mask[max(start_h, 0):start_h + width, max(start_w, 0):start_w + width] = True
+    return mask
 
-def opticalSystem(im, diameter):
+def opticalSystem(im, diameter, kind='circle', seed=12345):
     """
     Apply occultation to the image, compute the 2D discrete Fourier transform of the image,
     generate random phase for the inverse transform, and perform inverse transform with phase correction.
+    Everything is computed in the precision of the image.
 
     Parameters:
     - im (numpy.ndarray): The input image.
-    - diameter (int): The diameter of the circle region to be occulted.
+    - diameter (int): The diameter of the circle region to be occulted, or the width of the square.
+    - kind (str): 'circle' to use occultCircle, or 'square' to use occultSquare.
+    - seed (int): The seed of the random phase.
 
     Returns:
     - numpy.ndarray: The modified image.
@@ -108,21 +325,287 @@ def opticalSystem(im, diameter):
     - numpy.ndarray: The mask indicating the occulted pixels.
     """
     # Apply occultation to the image
-    im, mask = occultCircle(im, diameter)
+    if kind == 'square':
+        im, mask = occultSquare(im, diameter)
+    elif kind == 'circle':
+        im, mask = occultCircle(im, diameter)
+    else:
+        raise ValueError("unknown occulter: " + str(kind))
     
     # Compute the 2D discrete Fourier transform of the image
     (IMa, IMp) = dft2(im)
     
-    # Generate random phase for the inverse transform
-    rng = np.random.default_rng(12345)
-    imR = rng.random(im.shape)
-    (_, Dphi) = dft2(imR)
+    # Generate random phase for the inverse transform, or reuse a cached one
+    Dphi = phaseScreen(im.shape, seed, im.dtype)
     
     # Perform inverse transform with phase correction
-    im = idft2(IMa, IMp - Dphi)
+    im = idft2(IMa, IMp - Dphi, im.shape)
     
     return im, Dphi, mask
 
+class ArrayCache:
+    """
+    Read-only arrays by key, kept in memory with least-recently-used eviction and
+    optionally saved to .npy files so that later runs can skip computing them.
+    """
+
+    def __init__(self, maxBytes=2**30, folder=None):
+        """
+        Parameters:
+        - maxBytes (int): The most memory the cached arrays may use.
+        - folder (str): The directory of the .npy files, or None to keep the arrays in memory only.
+        """
+        self.maxBytes = maxBytes
+        self.folder = folder
+        self.arrays = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, compute):
+        """
+        Return the array for a key, computing it only if it is neither in memory nor on disk.
+
+        Parameters:
+        - key (tuple): The parameters the array depends on.
+        - compute (function): Computes the array when it is not cached.
+
+        Returns:
+        - numpy.ndarray: The array, read-only.
+        """
+        with self.lock:  # Shared by the threads of a batch
+            if key in self.arrays:
+                self.arrays.move_to_end(key)  # Most recently used
+                return self.arrays[key]
+            path = None
+            array = None
+            if self.folder:
+                path = os.path.join(self.folder, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+                try:
+                    array = np.load(path)
+                except (OSError, ValueError):
+                    array = None
+            if array is None:
+                array = np.asarray(compute())
+                if path:
+                    try:
+                        os.makedirs(self.folder, exist_ok=True)
+                        temp = '%s.%d.tmp.npy' % (path, os.getpid())  # Unique per process
+                        np.save(temp, array)
+                        os.replace(temp, path)  # Replace in one step so readers never see half a file
+                    except OSError:
+                        pass
+            array.flags.writeable = False  # Shared between callers
+            self.arrays[key] = array
+            self.nbytes += array.nbytes
+            while self.nbytes > self.maxBytes and len(self.arrays) > 1:
+                (_, old) = self.arrays.popitem(last=False)  # Evict the least recently used
+                self.nbytes -= old.nbytes
+            return array
+
+    def clear(self):
+        """
+        Forget the arrays kept in memory; the .npy files are kept.
+        """
+        with self.lock:
+            self.arrays.clear()
+            self.nbytes = 0
+
+CACHE_FOLDER = os.path.expanduser(os.environ.get('CORONA_CACHE', '')) or None  # Directory of the .npy files; unset keeps the caches in memory only
+MASKS = ArrayCache(2**28, CACHE_FOLDER)  # Occulting masks by (shape, diameter, kind)
+SCREENS = ArrayCache(2**30, CACHE_FOLDER)  # Phase screens by (shape, seed, dtype)
+
+OCCULTERS = ('circle', 'square')  # Occulter geometries
+
+def occultMask(shape, diameter, kind='circle'):
+    """
+    Return the occulting mask of an image, from the cache when possible.
+
+    Parameters:
+    - shape (tuple): The shape of the image.
+    - diameter (int): The diameter of the circle, or the width of the square.
+    - kind (str): 'circle' or 'square'.
+
+    Returns:
+    - numpy.ndarray: The read-only mask.
+    """
+    shape = tuple(int(n) for n in shape)
+    if kind == 'circle':
+        compute = lambda: circleMask(shape, diameter)
+    elif kind == 'square':
+        compute = lambda: squareMask(shape, diameter)
+    else:
+        raise ValueError("unknown occulter: " + str(kind))
+    return MASKS.get(('mask', shape, int(diameter), kind), compute)
+
+def phaseScreen(shape, seed=12345, dtype=np.float64):
+    """
+    Return the random phase screen Dphi of an image, from the cache when possible.
+
+    Parameters:
+    - shape (tuple): The shape of the image.
+    - seed (int): The seed of the random image.
+    - dtype (numpy.dtype): The precision of the screen.
+
+    Returns:
+    - numpy.ndarray: The read-only phase of the transform of the random image.
+    """
+    shape = tuple(int(n) for n in shape)
+    def compute():
+        rng = np.random.default_rng(seed)
+        imR = rng.random(shape).astype(dtype, copy=False)  # Same random numbers in either precision
+        (_, Dphi) = dft2(imR)
+        return Dphi
+    return SCREENS.get(('phase', shape, int(seed), np.dtype(dtype).str), compute)
+
+FFT_BACKENDS = ('numpy', 'scipy', 'pyfftw')  # In increasing order of preference when autodetecting
+FFT = None  # The backend used by dft2 and idft2c, chosen by setBackend
+
+class FFTBackend:
+    """
+    Real 2D FFTs through numpy.fft, scipy.fft with worker threads, or pyFFTW with
+    saved wisdom and preplanned aligned buffers.
+    """
+
+    def __init__(self, name, workers=None):
+        """
+        Parameters:
+        - name (str): One of FFT_BACKENDS.
+        - workers (int): The number of threads, or None for one per core (ignored by numpy).
+        """
+        self.name = name
+        self.workers = workers or os.cpu_count() or 1
+        self.plans = {}  # pyFFTW plans by (thread, kind, shape, dtype, s, axes)
+        if name == 'scipy':
+            import scipy.fft
+            self.lib = scipy.fft
+        elif name == 'pyfftw':
+            import pyfftw
+            import pyfftw.builders
+            self.lib = pyfftw
+            self.wisdom = os.environ.get('CORONA_FFTW_WISDOM', os.path.expanduser('~/.coronagraph_fftw_wisdom'))
+            try:
+                with open(self.wisdom, 'rb') as file:
+                    pyfftw.import_wisdom(pickle.load(file))  # Reuse plans measured by earlier runs
+            except (OSError, pickle.UnpicklingError, EOFError, TypeError, ValueError):
+                pass
+            atexit.register(self.saveWisdom)
+        elif name == 'numpy':
+            self.lib = np.fft
+        else:
+            raise ValueError("unknown FFT backend: " + str(name))
+
+    def rfft2(self, a, axes=(-2, -1)):
+        """
+        Compute the 2D real-to-complex FFT over the given axes.
+        """
+        if self.name == 'scipy':
+            return self.lib.rfft2(a, axes=axes, workers=self.workers)
+        if self.name == 'pyfftw':
+            return self.plan('rfft2', a, None, axes)
+        return np.fft.rfft2(a, axes=axes)
+
+    def irfft2(self, A, s=None, axes=(-2, -1)):
+        """
+        Compute the 2D complex-to-real inverse FFT over the given axes.
+        """
+        if self.name == 'scipy':
+            return self.lib.irfft2(A, s, axes=axes, workers=self.workers)
+        if self.name == 'pyfftw':
+            return self.plan('irfft2', A, s, axes)
+        return np.fft.irfft2(A, s, axes=axes)
+
+    def plan(self, kind, a, s, axes):
+        """
+        Run a pyFFTW transform, planning it once per shape and thread and writing to a fresh aligned array.
+        """
+        key = (threading.get_ident(), kind, a.shape, a.dtype.str, None if s is None else tuple(s), tuple(axes))
+        fft = self.plans.get(key)
+        if fft is None:
+            build = getattr(self.lib.builders, kind)
+            fft = build(self.lib.empty_aligned(a.shape, a.dtype), s, axes=axes, threads=self.workers,
+                        planner_effort='FFTW_MEASURE', avoid_copy=False)
+            self.plans[key] = fft
+        out = self.lib.empty_aligned(fft.output_shape, fft.output_dtype)
+        # Copy into the plan's own buffer: pyFFTW uses a suitable input in place, and complex-to-real
+        # transforms overwrite their input. The buffer is why plans are not shared between threads.
+        fft.input_array[...] = a
+        return fft(output_array=out)
+
+    def saveWisdom(self):
+        """
+        Save the pyFFTW wisdom so the next run can skip planning.
+        """
+        try:
+            with open(self.wisdom, 'wb') as file:
+                pickle.dump(self.lib.export_wisdom(), file)
+        except OSError:
+            pass
+
+def setBackend(name=None, workers=None):
+    """
+    Choose the FFT backend used by dft2 and idft2c.
+
+    Parameters:
+    - name (str): One of FFT_BACKENDS, or None for the CORONA_FFT environment variable, or else
+      the fastest installed backend.
+    - workers (int): The number of threads, or None for the CORONA_FFT_WORKERS environment variable, or else one per core.
+
+    Returns:
+    - FFTBackend: The new backend.
+    """
+    global FFT
+    name = name or os.environ.get('CORONA_FFT')
+    workers = workers or int(os.environ.get('CORONA_FFT_WORKERS', 0)) or None
+    if name:
+        FFT = FFTBackend(name, workers)
+        return FFT
+    for name in reversed(FFT_BACKENDS):
+        try:
+            FFT = FFTBackend(name, workers)
+            return FFT
+        except ImportError:
+            continue  # Not installed, try the next one
+
+def getBackend():
+    """
+    Return the FFT backend, autodetecting it on first use.
+
+    Returns:
+    - FFTBackend: The current backend.
+    """
+    return FFT or setBackend()
+
+def checkBackends(shape=(240, 320), tol=1e-9):
+    """
+    Check that every installed FFT backend agrees with numpy.fft.
+
+    Parameters:
+    - shape (tuple): The shape of the random test image.
+    - tol (float): The largest allowed absolute difference.
+
+    Returns:
+    - bool: True if all installed backends agree within the tolerance.
+    """
+    rng = np.random.default_rng(12345)
+    im = rng.random(shape)
+    IM = np.fft.rfft2(im)
+    ok = True
+    for name in FFT_BACKENDS:
+        try:
+            backend = FFTBackend(name)
+        except ImportError:
+            print("%-6s not installed" % name)
+            continue
+        (a, A) = (im.copy(), IM.copy())
+        forward = np.max(np.abs(backend.rfft2(a) - IM))
+        inverse = np.max(np.abs(backend.irfft2(A, shape) - im))
+        kept = np.array_equal(a, im) and np.array_equal(A, IM)  # The transforms must not overwrite their inputs
+        good = forward <= tol * np.max(np.abs(IM)) and inverse <= tol and kept
+        ok = ok and good
+        print("%-6s forward %.3g inverse %.3g inputs %s %s" % (name, forward, inverse, "kept" if kept else "overwritten",
+                                                            "ok" if good else "FAILED"))
+    return ok
+
 def dft2(im):
     """
     Compute the 2D discrete Fourier transform of a grayscale image.
@@ -133,28 +616,41 @@ def dft2(im):
     Returns:
     - tuple: A tuple containing the magnitude and phase of the Fourier transform.
     """
-    IM = np.fft.rfft2(im)
+    IM = getBackend().rfft2(im)
     IMa = np.abs(IM)
     IMp = np.angle(IM)
     return (IMa, IMp)
 
-def idft2(IMa, IMp):
+def idft2(IMa, IMp, shape=None):
     """
     Compute the inverse 2D discrete Fourier transform.
 
     Parameters:
     - IMa (numpy.ndarray): The magnitude of the Fourier transform.
     - IMp (numpy.ndarray): The phase of the Fourier transform.
+    - shape (tuple): The shape of the output image, or None to infer an even width.
 
     Returns:
     - numpy.ndarray: The inverse Fourier transformed image.
     """
-    IM = IMa * (np.cos(IMp) + 1j * np.sin(IMp))
-    im = np.fft.irfft2(IM)
+    return idft2c(IMa * np.exp(1j * IMp), shape)
+
+def idft2c(IM, shape=None):
+    """
+    Compute the inverse 2D discrete Fourier transform of a complex spectrum, or of a stack
+    of spectra along the last two axes.
+
+    Parameters:
+    - IM (numpy.ndarray): The complex Fourier transform.
+    - shape (tuple): The shape of the output image, or None to infer an even width.
+
+    Returns:
+    - numpy.ndarray: The inverse Fourier transformed image, clipped to the range [0, 1].
+    """
+    im = getBackend().irfft2(IM, shape)
     
-    # Clip pixel values to the range [0, 1]
-    im[im < 0] = 0
-    im[im > 1] = 1
+    # Clip pixel values to the range [0, 1] without a temporary
+    np.clip(im, 0, 1, out=im)
     
     return im
 
@@ -164,52 +660,664 @@ def occultError(im, mask):
 
     Parameters:
     - im (numpy.ndarray): The input image.
-    - mask (numpy.ndarray): The mask indicating the occulted pixels.
+    - mask (numpy.ndarray or MaskIndex): The mask indicating the occulted pixels, or its index.
 
     Returns:
-    - float: The occultation error.
+    - float: The occultation error, accumulated in double precision.
     """
-    error = np.sum(im[mask]**2)
+    if not isinstance(mask, MaskIndex):
+        mask = MaskIndex(mask)
+    error = mask.error(im)
     return error
 
-def gerchbergSaxton(im, maxIters, Dphi, mask):
+def occultMetrics(im, mask):
+    """
+    Compute the occultation error of the image together with its RMS, its peak and the energy outside the mask.
+
+    Parameters:
+    - im (numpy.ndarray): The input image.
+    - mask (numpy.ndarray or MaskIndex): The mask indicating the occulted pixels, or its index.
+
+    Returns:
+    - dict: The error, rms, max and outside values, accumulated in double precision.
+    """
+    if not isinstance(mask, MaskIndex):
+        mask = MaskIndex(mask)
+    return mask.metrics(im)
+
+class MaskIndex:
+    """
+    The flat indices of the occulted pixels, so the occultation error of each frame is a
+    gather into a preallocated buffer and one dot product instead of a boolean selection,
+    a squared temporary and a sum. Build it once per run and pass it wherever a mask is taken.
+    """
+
+    def __init__(self, mask):
+        """
+        Parameters:
+        - mask (numpy.ndarray): The mask indicating the occulted pixels.
+        """
+        self.shape = mask.shape
+        self.index = np.flatnonzero(mask)
+        self.local = threading.local()  # One gather buffer per thread and image type
+
+    def gather(self, im):
+        """
+        Gather the occulted pixels of an image into the buffer of this thread.
+
+        Parameters:
+        - im (numpy.ndarray): The input image, with the shape of the mask.
+
+        Returns:
+        - numpy.ndarray: The occulted pixels, valid until the next gather in this thread.
+        """
+        if im.shape != self.shape:
+            raise ValueError("image shape %s does not match mask shape %s" % (im.shape, self.shape))
+        buffers = self.local.__dict__.setdefault('buffers', {})
+        buf = buffers.get(im.dtype)
+        if buf is None:
+            buf = buffers[im.dtype] = np.empty(len(self.index), im.dtype)
+        return np.take(im.ravel(), self.index, out=buf)  # ravel is a view for contiguous frames
+
+    def error(self, im):
+        """
+        Compute the occultation error of an image.
+
+        Parameters:
+        - im (numpy.ndarray): The input image.
+
+        Returns:
+        - float: The sum of the squared occulted pixels, accumulated in double precision.
+        """
+        return energy(self.gather(im))
+
+    def metrics(self, im):
+        """
+        Compute the occultation error of an image with its RMS, its peak and the energy outside the mask.
+
+        Parameters:
+        - im (numpy.ndarray): The input image.
+
+        Returns:
+        - dict: The error, rms, max and outside values.
+        """
+        v = self.gather(im)
+        error = energy(v)
+        peak = float(np.abs(v).max()) if len(v) else 0.0
+        return {'error': error, 'rms': float(np.sqrt(error / max(len(v), 1))), 'max': peak,
+                'outside': energy(im.ravel()) - error}
+
+def energy(v):
+    """
+    Compute the sum of squares of a vector without a squared temporary.
+
+    Parameters:
+    - v (numpy.ndarray): The input vector.
+
+    Returns:
+    - float: The sum of squares, accumulated in double precision.
+    """
+    if v.dtype == np.float64:
+        return float(np.dot(v, v))  # Fused multiply-add in BLAS
+    return float(np.einsum('i,i->', v, v, dtype=np.float64))  # Single precision is widened in buffered chunks
+
+def gerchbergSaxton(im, maxIters, Dphi, mask, memory=2**28):
     """
     Perform the Gerchberg-Saxton algorithm.
 
     This function takes an input image, performs the Gerchberg-Saxton algorithm for a specified number of iterations,
-    and returns a list of generated images and a list of errors for each iteration.
+    and returns a list of generated images and a list of errors for each iteration. Use gsFrames to process the frames
+    one at a time without keeping them all in memory.
 
     Parameters:
     - im (numpy.ndarray): The input image.
     - maxIters (int): Maximum number of iterations.
     - Dphi (numpy.ndarray): Random phase for the inverse transform.
     - mask (numpy.ndarray): The mask indicating the occulted pixels.
+    - memory (int): The memory budget in bytes for one block of frames.
 
     Returns:
     - list: List of generated images.
     - list: List of errors for each iteration.
     """
-    # Perform the Gerchberg-Saxton algorithm
-    (IMa, IMp) = dft2(im)  # Compute the magnitude and phase of the Fourier transform
     images = []  # List to store generated images
     errors = []  # List to store errors for each iteration
+    for k, im, error in gsFrames(im, maxIters, Dphi, mask, memory):
+        images.append(im)  # Add generated image to the list
+        errors.append(error)  # Add error to the list
+    return images, errors  # Return the list of generated images and errors
+
+def gsFrames(im, maxIters, Dphi, mask, memory=2**28, verbose=True):
+    """
+    Generate the Gerchberg-Saxton frames one at a time.
+
+    Frames are inverse transformed in blocks, with one multi-axis transform per block, so
+    memory use is bounded by the block budget rather than the number of iterations.
+
+    Parameters:
+    - im (numpy.ndarray): The input image.
+    - maxIters (int): Maximum number of iterations.
+    - Dphi (numpy.ndarray): Random phase for the inverse transform.
+    - mask (numpy.ndarray or MaskIndex): The mask indicating the occulted pixels, or its index.
+    - memory (int): The memory budget in bytes for one block of frames.
+    - verbose (bool): Whether to print the iteration messages.
+
+    Yields:
+    - tuple: The iteration number, the generated image and its occultation error.
+    """
+    shape = im.shape
+    index = mask if isinstance(mask, MaskIndex) else MaskIndex(mask)  # Index the occulted pixels once for all frames
+    IM = getBackend().rfft2(im)  # Keep the spectrum complex rather than as magnitude and phase
+    step = np.exp(1j * Dphi / max(maxIters, 1))  # Unit phasor that advances alpha by 1/maxIters
+    block = frameBlock(IM, shape, memory)  # Number of frames transformed together
     
-    for k in range(maxIters + 1):
-        print("Iteration %d of %d" % (k, maxIters))
+    for first in range(0, maxIters + 1, block):
+        # The interpolated phase (1 - alpha) * IMp + alpha * (IMp + Dphi) is IMp + alpha * Dphi,
+        # so each frame's spectrum is the previous one times the unit phasor
+        stack = np.empty((min(block, maxIters + 1 - first),) + IM.shape, IM.dtype)
+        for j in range(len(stack)):
+            if first + j > 0:
+                np.multiply(IM, step, out=stack[j])
+            else:
+                stack[j] = IM
+            IM = stack[j]
+        IM = IM.copy()  # Release the block once its frames are done
+        frames = idft2c(stack, shape)  # Perform inverse transforms of the whole block at once
+        del stack
         
-        if k == 0:
-            im = idft2(IMa, IMp)  # Perform inverse transform without phase correction
-        elif k == maxIters:
-            im = idft2(IMa, IMp + Dphi)  # Perform inverse transform with phase correction
+        for j, im in enumerate(frames):
+            if verbose:
+                print("Iteration %d of %d" % (first + j, maxIters))
+            yield first + j, im, occultError(im, index)  # Hand the frame on before computing the next block
+        del frames, im
+
+SWEEP_FIELDS = ['image', 'precision', 'diameter', 'kind', 'seed', 'maxIters', 'error', 'seconds']  # Columns of the sweep table
+SHARED = None  # The image shared with the sweep worker processes
+
+def sweep(name, table, diameters, kinds=('circle',), seeds=(12345,), iters=(10,), workers=None, dtype=np.float64):
+    """
+    Run the simulation over a grid of parameters in a pool of processes and append the final
+    occultation errors to a CSV table. Rows already in the table for the same image and precision
+    are skipped, so an interrupted sweep resumes where it stopped.
+
+    Parameters:
+    - name (str): The name of the image file.
+    - table (str): The CSV file of results.
+    - diameters (list): The occulter diameters or widths.
+    - kinds (list): The occulter geometries, 'circle' and/or 'square'.
+    - seeds (list): The seeds of the random phase.
+    - iters (list): The maximum numbers of iterations.
+    - workers (int): The number of processes, or None for one per core.
+    - dtype (numpy.dtype): The precision of the simulation.
+
+    Returns:
+    - list: The rows computed by this call.
+    """
+    for kind in kinds:
+        if kind not in OCCULTERS:
+            raise ValueError("unknown occulter %r, expected one of %s" % (kind, ', '.join(OCCULTERS)))
+    (image, precision) = (os.path.normpath(name), np.dtype(dtype).name)
+    done = set()
+    if os.path.exists(table):
+        with open(table, newline='') as file:
+            reader = csv.DictReader(file)
+            if reader.fieldnames and reader.fieldnames != SWEEP_FIELDS:
+                raise ValueError("%s has the columns %s, not %s; use a new table" % (table, reader.fieldnames, SWEEP_FIELDS))
+            for row in reader:
+                if (row['image'], row['precision']) == (image, precision):  # Runs of other images or precisions do not count
+                    done.add((int(row['diameter']), row['kind'], int(row['seed']), int(row['maxIters'])))
+    tasks = [task for task in itertools.product(diameters, kinds, seeds, iters) if task not in done]
+    print("%d run(s) of %s in %s done, %d to go" % (len(done), image, precision, len(tasks)))
+    if not tasks:
+        return []
+    im = loadImage(name, dtype)
+    shm = shared_memory.SharedMemory(create=True, size=im.nbytes)  # Workers map the image instead of unpickling it
+    rows = []
+    try:
+        np.ndarray(im.shape, im.dtype, shm.buf)[:] = im
+        new = not os.path.exists(table) or os.path.getsize(table) == 0
+        with open(table, 'a', newline='') as file, \
+             ProcessPoolExecutor(workers, initializer=attachImage, initargs=(shm.name, im.shape, im.dtype.str)) as pool:
+            writer = csv.DictWriter(file, SWEEP_FIELDS)
+            if new:
+                writer.writeheader()
+            futures = [pool.submit(sweepRun, *task) for task in tasks]
+            for future in as_completed(futures):
+                row = dict(future.result(), image=image, precision=precision)
+                writer.writerow(row)  # Stream each result as soon as it is ready
+                file.flush()
+                rows.append(row)
+                print("diameter %(diameter)d %(kind)s seed %(seed)d iterations %(maxIters)d: error %(error).6g" % row)
+    finally:
+        shm.close()
+        shm.unlink()
+    return rows
+
+def attachImage(name, shape, dtype):
+    """
+    Attach a sweep worker process to the shared image.
+
+    Parameters:
+    - name (str): The name of the shared memory block.
+    - shape (tuple): The shape of the image.
+    - dtype (str): The type of the image.
+    """
+    global SHARED
+    shm = shared_memory.SharedMemory(name=name)
+    SHARED = (shm, np.ndarray(shape, dtype, shm.buf))  # Keep the block open while the array is used
+    sys.stdout = open(os.devnull, 'w')  # Silence the iteration messages
+
+def sweepRun(diameter, kind, seed, maxIters):
+    """
+    Run one simulation of a sweep on the shared image.
+
+    Parameters:
+    - diameter (int): The occulter diameter or width.
+    - kind (str): The occulter geometry.
+    - seed (int): The seed of the random phase.
+    - maxIters (int): Maximum number of iterations.
+
+    Returns:
+    - dict: The parameters, the final occultation error and the time taken.
+    """
+    begin = time.perf_counter()
+    im = SHARED[1].copy()  # Occultation writes to the image
+    im, Dphi, mask = opticalSystem(im, diameter, kind, seed)
+    error = None
+    for k, im, error in gsFrames(im, maxIters, Dphi, mask):
+        pass  # Only the final error is kept
+    return {'diameter': diameter, 'kind': kind, 'seed': seed, 'maxIters': maxIters,
+            'error': error, 'seconds': time.perf_counter() - begin}
+
+BATCH_FIELDS = ['image', 'iteration', 'error']  # Columns of the batch table
+
+def batch(pattern, table, diameter, kind='circle', seed=12345, maxIters=10, workers=None, prefetch=4,
+          memory=2**28, dtype=np.float64):
+    """
+    Run the simulation over many images in a pool of threads and write the error curve of each
+    image to a CSV table. Images are decoded ahead of the workers by a reader thread, and the
+    masks, phase screens and FFT plans are computed once and shared by every image of a size.
+    While the batch runs, each thread's FFTs use an equal share of the cores.
+
+    Parameters:
+    - pattern (str): A glob pattern of image files, or a .txt or .lst manifest with one file per line.
+    - table (str): The CSV file of error curves.
+    - diameter (int): The occulter diameter or width.
+    - kind (str): The occulter geometry, 'circle' or 'square'.
+    - seed (int): The seed of the random phase.
+    - maxIters (int): Maximum number of iterations.
+    - workers (int): The number of threads, or None for one per core.
+    - prefetch (int): The number of decoded images kept ahead of the workers.
+    - memory (int): The memory budget in bytes for one block of frames of each thread.
+    - dtype (numpy.dtype): The precision of the simulation.
+
+    Returns:
+    - dict: The error curve of each image by name.
+    """
+    global FFT
+    if kind not in OCCULTERS:
+        raise ValueError("unknown occulter %r, expected one of %s" % (kind, ', '.join(OCCULTERS)))
+    names = batchNames(pattern)
+    print("%d image(s) to process" % len(names))
+    workers = workers or os.cpu_count() or 1
+    images = queue.Queue(prefetch)  # Bounded so the reader stays only a few images ahead
+    reader = threading.Thread(target=readImages, args=(names, images, dtype), daemon=True)
+    reader.start()
+    curves = {}
+    begin = time.perf_counter()
+    previous = getBackend()
+    share = max(1, (os.cpu_count() or 1) // workers)  # Split the cores between the image threads and the FFT threads
+    if previous.name != 'numpy' and previous.workers > share:
+        setBackend(previous.name, share)
+    try:
+        with open(table, 'w', newline='') as file, ThreadPoolExecutor(workers) as pool:
+            writer = csv.writer(file)
+            writer.writerow(BATCH_FIELDS)
+            pending = {}
+            def collect(done):
+                for future in done:
+                    name = pending.pop(future)
+                    (errors, seconds) = future.result()
+                    writer.writerows([name, k, error] for k, error in enumerate(errors))  # Stream each curve as soon as it is ready
+                    curves[name] = errors
+                    print("%s: error %.6g to %.6g in %.2f s" % (name, errors[0], errors[-1], seconds))
+            for name, im in iter(images.get, None):
+                if isinstance(im, Exception):
+                    print("Skipping %s: %s" % (name, im))
+                    continue
+                if len(pending) >= 2 * workers:
+                    collect(wait(pending, return_when=FIRST_COMPLETED)[0])  # Hold at most two images per thread
+                pending[pool.submit(batchRun, im, diameter, kind, seed, maxIters, memory)] = name
+            collect(wait(pending)[0])
+    finally:
+        FFT = previous
+    seconds = time.perf_counter() - begin
+    print("%d image(s) in %.2f s, %.2f images/s" % (len(curves), seconds, len(curves) / seconds if seconds else 0))
+    return curves
+
+def batchNames(pattern):
+    """
+    List the image files of a batch.
+
+    Parameters:
+    - pattern (str): A glob pattern, or a .txt or .lst manifest with one file per line,
+      relative to the manifest.
+
+    Returns:
+    - list: The names of the image files.
+    """
+    if os.path.splitext(pattern)[1].lower() in ('.txt', '.lst'):
+        folder = os.path.dirname(pattern)
+        with open(pattern) as file:
+            return [os.path.join(folder, line.strip()) for line in file if line.strip() and not line.startswith('#')]
+    return sorted(glob.glob(pattern))
+
+def readImages(names, images, dtype=np.float64):
+    """
+    Decode images into a queue for the batch workers, ending with None.
+
+    Parameters:
+    - names (list): The names of the image files.
+    - images (queue.Queue): Receives a tuple of each name and its image, or the error that stopped it loading.
+    - dtype (numpy.dtype): The precision of the images.
+    """
+    try:
+        for name in names:
+            try:
+                images.put((name, loadImage(name, dtype)))
+            except (OSError, ValueError) as error:
+                images.put((name, error))
+    finally:
+        images.put(None)  # Always end the batch, even if decoding fails unexpectedly
+
+def batchRun(im, diameter, kind, seed, maxIters, memory=2**28):
+    """
+    Run one simulation of a batch.
+
+    Parameters:
+    - im (numpy.ndarray): The input image, which is occulted in place.
+    - diameter (int): The occulter diameter or width.
+    - kind (str): The occulter geometry.
+    - seed (int): The seed of the random phase.
+    - maxIters (int): Maximum number of iterations.
+    - memory (int): The memory budget in bytes for one block of frames.
+
+    Returns:
+    - list: The occultation error of each iteration.
+    - float: The time taken in seconds.
+    """
+    begin = time.perf_counter()
+    im, Dphi, mask = opticalSystem(im, diameter, kind, seed)  # The mask and Dphi come from the caches
+    errors = [error for k, im, error in gsFrames(im, maxIters, Dphi, mask, memory, verbose=False)]
+    return errors, time.perf_counter() - begin
+
+def precisionReport(name, diameter, maxIters):
+    """
+    Run the simulation in double and single precision and print how the errors differ.
+
+    Parameters:
+    - name (str): The name of the image file.
+    - diameter (int): The diameter of the circle region to be occulted.
+    - maxIters (int): Maximum number of iterations.
+
+    Returns:
+    - dict: The errors in each precision, and the largest relative error and pixel differences.
+    """
+    results = {}
+    for precision, dtype in PRECISIONS.items():
+        im = loadImage(name, dtype)
+        im, Dphi, mask = opticalSystem(im, diameter)
+        results[precision] = list(gsFrames(im, maxIters, Dphi, mask))
+    print("Iteration  Error (double)  Error (single)  Relative difference")
+    relative = []
+    pixels = []
+    for (k, im64, e64), (_, im32, e32) in zip(results['double'], results['single']):
+        relative.append(abs(e32 - e64) / e64 if e64 else abs(e32))
+        pixels.append(np.max(np.abs(im32 - im64)))
+        print("%9d  %14.6g  %14.6g  %19.3g" % (k, e64, e32, relative[-1]))
+    print("Largest relative error difference %.3g, largest pixel difference %.3g" % (max(relative), max(pixels)))
+    return {'double': [e for _, _, e in results['double']], 'single': [e for _, _, e in results['single']],
+            'relative': max(relative), 'pixel': float(max(pixels))}
+
+def outOfCore(source, target, diameter, alpha=None, memory=2**28, scratch=None, shape=None, dtype=np.float64):
+    """
+    Run opticalSystem on an image too large for memory, and optionally form one Gerchberg-Saxton frame.
+
+    The image is read from a memory-mapped .npy or raw file, the 2D transforms are done as row
+    and column passes over disk-backed scratch arrays, and the result is written to a memory-mapped
+    .npy file. Only bands of rows or columns within the memory budget are held in memory.
+
+    Parameters:
+    - source (str): The .npy file, or a raw file of the given shape and dtype, holding the image in [0, 1].
+    - target (str): The .npy file to write the result to.
+    - diameter (int): The diameter of the circle region to be occulted.
+    - alpha (float): None to stop at the output of opticalSystem, or the interpolation factor of the
+      Gerchberg-Saxton frame to compute from it, from 0 to 1.
+    - memory (int): The memory budget in bytes for one band.
+    - scratch (str): The directory for the scratch arrays, or None for the system default.
+    - shape (tuple): The shape of a raw source file.
+    - dtype (numpy.dtype): The type of a raw source file.
+
+    Returns:
+    - numpy.memmap: The resulting image.
+    - float: Its occultation error.
+    """
+    import shutil
+    import tempfile
+    if source.endswith('.npy'):
+        im = np.load(source, mmap_mode='r')
+    elif shape is None:
+        raise ValueError("%s is not a .npy file; give the shape and dtype of the raw image it holds" % source)
+    else:
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if os.path.getsize(source) != size:
+            raise ValueError("%s holds %d bytes, not the %d of a %s %s image" % (source, os.path.getsize(source), size,
+                                                                             'x'.join(map(str, shape)), np.dtype(dtype).name))
+        im = np.memmap(source, dtype, 'r', shape=shape)
+    if im.ndim != 2:
+        raise ValueError("%s is not a grayscale image: shape %s" % (source, im.shape))
+    (h, w) = im.shape
+    real = im.dtype
+    cplx = np.result_type(real, np.complex64)
+    folder = tempfile.mkdtemp(dir=scratch)
+    scratchArray = lambda name, shape, dtype: np.lib.format.open_memmap(os.path.join(folder, name + '.npy'), 'w+', dtype, shape)
+    try:
+        rows = bandSize(w * np.dtype(cplx).itemsize * 4, memory)
+        out = np.lib.format.open_memmap(target, 'w+', real, (h, w))
+        
+        # Apply occultation to the image, and draw the random image in the same order as opticalSystem
+        rng = np.random.default_rng(12345)
+        rand = scratchArray('random', (h, w), real)
+        for r in range(0, h, rows):
+            band = np.array(im[r:r+rows])
+            band[circleMask((h, w), diameter, r, r + len(band))] = 0
+            out[r:r+len(band)] = band
+            rand[r:r+len(band)] = rng.random(band.shape)
+        
+        # Compute the 2D discrete Fourier transforms of both images
+        IM = oocRfft2(out, scratchArray('IM', (h, w // 2 + 1), cplx), memory)
+        R = oocRfft2(rand, scratchArray('R', (h, w // 2 + 1), cplx), memory)
+        
+        # Perform inverse transform with phase correction, IM * exp(-1j * Dphi)
+        applyPhase(IM, R, -1, memory)
+        oocIrfft2(IM, out, memory)
+        
+        if alpha is not None:
+            # Gerchberg-Saxton frame with the interpolated phase IMp + alpha * Dphi
+            IM = oocRfft2(out, IM, memory)
+            applyPhase(IM, R, alpha, memory)
+            oocIrfft2(IM, out, memory)
+        del IM, R, rand
+        
+        # Compute the occultation error one band at a time
+        error = 0.0
+        for r in range(0, h, rows):
+            band = out[r:r+rows]
+            error += occultError(band, circleMask((h, w), diameter, r, r + len(band)))
+        out.flush()
+        return out, error
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+def bandSize(bytesPerLine, memory):
+    """
+    Compute how many rows or columns fit in the memory budget of one band.
+
+    Parameters:
+    - bytesPerLine (int): The memory used per row or column.
+    - memory (int): The memory budget in bytes.
+
+    Returns:
+    - int: The number of rows or columns per band, at least 1.
+    """
+    return max(1, int(memory // bytesPerLine))
+
+def oocRfft2(im, IM, memory=2**28):
+    """
+    Compute the 2D real FFT of a disk-backed image as a pass over bands of rows then of columns.
+
+    Parameters:
+    - im (numpy.ndarray): The h x w real image, e.g. a memmap.
+    - IM (numpy.ndarray): The h x (w // 2 + 1) complex output, e.g. a memmap; may not share memory with im.
+    - memory (int): The memory budget in bytes for one band.
+
+    Returns:
+    - numpy.ndarray: IM, holding the transform.
+    """
+    (h, w) = im.shape
+    rows = bandSize(IM.shape[1] * IM.itemsize * 3, memory)
+    for r in range(0, h, rows):
+        IM[r:r+rows] = np.fft.rfft(im[r:r+rows], axis=1)
+    cols = bandSize(h * IM.itemsize * 3, memory)
+    for c in range(0, IM.shape[1], cols):
+        IM[:, c:c+cols] = np.fft.fft(IM[:, c:c+cols], axis=0)
+    return IM
+
+def oocIrfft2(IM, im, memory=2**28):
+    """
+    Compute the inverse of oocRfft2, clipping the image to the range [0, 1].
+
+    Parameters:
+    - IM (numpy.ndarray): The h x (w // 2 + 1) complex spectrum, e.g. a memmap; overwritten.
+    - im (numpy.ndarray): The h x w real output, e.g. a memmap.
+    - memory (int): The memory budget in bytes for one band.
+
+    Returns:
+    - numpy.ndarray: im, holding the image.
+    """
+    (h, w) = im.shape
+    cols = bandSize(h * IM.itemsize * 3, memory)
+    for c in range(0, IM.shape[1], cols):
+        IM[:, c:c+cols] = np.fft.ifft(IM[:, c:c+cols], axis=0)
+    rows = bandSize(IM.shape[1] * IM.itemsize * 3, memory)
+    for r in range(0, h, rows):
+        band = np.fft.irfft(IM[r:r+rows], w, axis=1)
+        np.clip(band, 0, 1, out=band)
+        im[r:r+rows] = band
+    return im
+
+def applyPhase(IM, R, alpha, memory=2**28):
+    """
+    Multiply a disk-backed spectrum by exp(1j * alpha * Dphi), where Dphi is the phase of R.
+
+    Parameters:
+    - IM (numpy.ndarray): The complex spectrum, e.g. a memmap; updated in place.
+    - R (numpy.ndarray): The complex spectrum whose phase is Dphi.
+    - alpha (float): The multiple of Dphi to apply.
+    - memory (int): The memory budget in bytes for one band.
+    """
+    rows = bandSize(IM.shape[1] * IM.itemsize * 4, memory)
+    for r in range(0, IM.shape[0], rows):
+        IM[r:r+rows] *= np.exp(1j * alpha * np.angle(R[r:r+rows])).astype(IM.dtype, copy=False)
+
+def phaseRetrieval(im, mask, maxIters, method='gs', beta=0.9, tol=1e-3, patience=5, verbose=True):
+    """
+    Retrieve the phase by alternating projections between the Fourier magnitude of the image
+    and the image-domain constraints (zero in the occulted region, values in [0, 1]), stopping
+    early when the occultation error stops improving. The last frame yielded is the best one
+    found, since hio and raar need not end on their lowest error.
+
+    Parameters:
+    - im (numpy.ndarray): The input image, whose Fourier magnitude is kept.
+    - mask (numpy.ndarray): The mask indicating the occulted pixels.
+    - maxIters (int): Maximum number of iterations.
+    - method (str): 'gs' for Gerchberg-Saxton error reduction, 'hio' for hybrid input-output,
+      or 'raar' for relaxed averaged alternating reflections.
+    - beta (float): The feedback or relaxation parameter of 'hio' and 'raar'.
+    - tol (float): The smallest useful improvement of the best error, as a fraction of the first error.
+    - patience (int): Stop after this many iterations in a row without a useful improvement.
+    - verbose (bool): Whether to print the iteration messages.
+
+    Yields:
+    - tuple: The iteration number, the Fourier-consistent image clipped to [0, 1] and its occultation error.
+    """
+    if method not in ('gs', 'hio', 'raar'):
+        raise ValueError("unknown phase retrieval method: " + str(method))
+    backend = getBackend()
+    shape = im.shape
+    IMa = np.abs(backend.rfft2(im))  # The Fourier magnitude constraint
+    tiny = np.finfo(im.dtype).tiny
+
+    def fourier(x):
+        # Keep the phase of x and impose the magnitude IMa
+        X = backend.rfft2(x)
+        X *= IMa / np.maximum(np.abs(X), tiny)
+        return backend.irfft2(X, shape)
+
+    def image(x):
+        # Zero in the occulted region and clip to [0, 1]
+        y = np.clip(x, 0, 1)
+        y[mask] = 0
+        return y
+
+    index = MaskIndex(mask)  # Index the occulted pixels once for all iterations
+    x = image(im)
+    best = None
+    stalled = 0
+    for k in range(maxIters + 1):
+        y = fourier(x)
+        frame = np.clip(y, 0, 1)
+        error = occultError(frame, index)
+        if verbose:
+            print("Iteration %d of %d" % (k, maxIters))
+        if best is None:
+            (first, best) = (error, error)
+        elif best - error > tol * first:
+            (best, stalled) = (error, 0)
         else:
-            alpha = k / maxIters
-            im = idft2(IMa, (1 - alpha) * IMp + alpha * (IMp + Dphi))  # Perform inverse transform with interpolated phase
+            best = min(best, error)
+            stalled += 1
+        if error <= best:
+            bestFrame = frame
+        if stalled >= patience or k == maxIters:
+            yield k, bestFrame, best  # End on the best iterate rather than the last
+            break  # Converged, or no longer improving (hio and raar need not decrease every iteration)
+        yield k, frame, error
         
-        images.append(im)  # Add generated image to the list
-        error = occultError(im, mask)  # Compute the occultation error
-        errors.append(error)  # Add error to the list
-    
-    return images, errors  # Return the list of generated images and errors
+        if method == 'gs':
+            x = image(y)
+        elif method == 'hio':
+            z = image(y)
+            x = np.where(z == y, y, x - beta * y)  # Feedback where y violates the constraints
+        else:
+            z = image(2 * y - x)  # Project the Fourier reflection
+            x = beta / 2 * (2 * z - (2 * y - x) + x) + (1 - beta) * y
+
+def frameBlock(IM, shape, memory):
+    """
+    Compute how many frames fit in the memory budget of one block.
+
+    Parameters:
+    - IM (numpy.ndarray): The complex spectrum of one frame.
+    - shape (tuple): The shape of one frame.
+    - memory (int): The memory budget in bytes.
+
+    Returns:
+    - int: The number of frames per block, at least 1.
+    """
+    frame = np.prod(shape) * IM.real.itemsize  # Real output frame
+    perFrame = 2 * IM.nbytes + frame  # Stacked spectrum, transform workspace and output frame
+    return max(1, int(memory // perFrame))
 
 def saveFrames(images, errors):
     """
@@ -222,39 +1330,514 @@ def saveFrames(images, errors):
     Returns:
     - None
     """
-    # Create an empty image with the same shape as the first generated image
-    shape = (images[0].shape[0], images[0].shape[1], 3)
-    image = np.zeros(shape, images[0].dtype)
-
     # Calculate the maximum number of iterations and maximum error value
     maxIters = len(images) - 1
     maxErrors = max(errors)
 
     # Iterate over each iteration
     for k in range(maxIters + 1):
-        # Plot the errors for each iteration
-        plt.plot(errors[:k+1], color='red')
-        plt.xlabel("Iteration")
-        plt.ylabel("Sum Square Error")
-        plt.xlim(0, maxIters)
-        plt.ylim(0, maxErrors)
-        
-        # Set the RGB channels of the image to the current generated image
-        image[:, :, 0] = images[k]
-        image[:, :, 1] = images[k]
-        image[:, :, 2] = images[k]
-        
-        # Display the image with the errors as the background
-        plt.imshow(image, extent=(0, maxIters, 0, maxErrors))
-        plt.gca().set_aspect(maxIters / maxErrors)
-        
-        # Set the title of the plot
-        plt.title("Coronagraph Simulation")
+        saveFrame(k, images[k], errors[:k+1], maxIters, maxErrors)
+
+def saveFrame(k, im, errors, maxIters, maxErrors, prefix='coronagraph', show=True):
+    """
+    Save one frame as an image over the plot of the errors so far.
+
+    Parameters:
+    - k (int): The iteration number.
+    - im (numpy.ndarray): The generated image.
+    - errors (list): The errors up to and including this iteration.
+    - maxIters (int): Maximum number of iterations.
+    - maxErrors (float): The top of the error axis.
+    - prefix (str): The start of the PNG file name.
+    - show (bool): Whether to display the plot.
+
+    Returns:
+    - None
+    """
+    drawFrame(im, errors, maxIters, maxErrors)
+    
+    # Save the plot as a PNG file
+    plt.savefig(prefix + str(k) + '.png')
+    
+    # Display the plot
+    if show:
+        plt.show()
+
+def drawFrame(im, errors, maxIters, maxErrors):
+    """
+    Draw one frame over the plot of the errors so far in the current figure.
+
+    Parameters:
+    - im (numpy.ndarray): The generated image.
+    - errors (list): The errors up to and including this iteration.
+    - maxIters (int): Maximum number of iterations.
+    - maxErrors (float): The top of the error axis.
+
+    Returns:
+    - None
+    """
+    # Start from an empty figure so artists do not pile up across frames
+    plt.clf()
+
+    # Plot the errors for each iteration
+    plt.plot(errors, color='red')
+    plt.xlabel("Iteration")
+    plt.ylabel("Sum Square Error")
+    plt.xlim(0, maxIters)
+    plt.ylim(0, maxErrors)
+    
+    # Set the RGB channels of the image to the current generated image
+    image = np.zeros(im.shape + (3,), im.dtype)
+    image[:, :, 0] = im
+    image[:, :, 1] = im
+    image[:, :, 2] = im
+    
+    # Display the image with the errors as the background
+    plt.imshow(image, extent=(0, maxIters, 0, maxErrors))
+    plt.gca().set_aspect(maxIters / maxErrors)
+    
+    # Set the title of the plot
+    plt.title("Coronagraph Simulation")
+
+def renderFrame(im, errors, maxIters, maxErrors):
+    """
+    Render one frame over the plot of the errors so far into an array, without saving a file.
+
+    Parameters:
+    - im (numpy.ndarray): The generated image.
+    - errors (list): The errors up to and including this iteration.
+    - maxIters (int): Maximum number of iterations.
+    - maxErrors (float): The top of the error axis.
+
+    Returns:
+    - numpy.ndarray: The rendered figure as a height x width x 3 uint8 RGB array.
+    """
+    drawFrame(im, errors, maxIters, maxErrors)
+    canvas = plt.gcf().canvas
+    canvas.draw()
+    return np.asarray(canvas.buffer_rgba())[:, :, :3]
+
+class FrameRenderer:
+    """
+    Render frames like renderFrame, but draw the axes, labels and title with matplotlib only
+    once. Each frame is then composited with NumPy into a preallocated uint8 buffer, and the
+    error polyline is extended by one segment per frame.
+    """
+
+    def __init__(self):
+        self.key = None  # (image shape, maxIters, maxErrors) the background was drawn for
+        self.buffer = None
+
+    def __call__(self, im, errors, maxIters, maxErrors):
+        """
+        Parameters:
+        - im (numpy.ndarray): The generated image.
+        - errors (list): The errors up to and including this iteration.
+        - maxIters (int): Maximum number of iterations.
+        - maxErrors (float): The top of the error axis.
+
+        Returns:
+        - numpy.ndarray: The rendered frame as a height x width x 3 uint8 RGB array. The same
+          buffer is reused by the next call.
+        """
+        key = (im.shape, maxIters, maxErrors)
+        if key != self.key or len(errors) < self.segments + 1:
+            self.setup(im.shape, maxIters, maxErrors)  # New axes, or a new sequence of errors
+            self.key = key
+        for k in range(self.segments + 1, len(errors)):
+            self.addSegment(k - 1, errors[k - 1], k, errors[k])
+        (r0, r1, c0, c1) = self.box
         
-        # Save the plot as a PNG file
-        plt.savefig('coronagraph' + str(k) + '.png')
+        # Scale the image to the axes box by nearest neighbour and copy it to all three channels
+        pixels = im[self.rows[:, None], self.cols[None, :]]
+        np.multiply(pixels, 255, out=self.scratch, casting='unsafe')
+        self.buffer[r0:r1, c0:c1, :] = self.scratch[:, :, None]
         
-        # Display the plot
-        plt.show()
+        # Draw the error polyline over the image
+        if self.lineRows:
+            self.buffer[np.concatenate(self.lineRows), np.concatenate(self.lineCols)] = (255, 0, 0)
+        return self.buffer
+
+    def setup(self, shape, maxIters, maxErrors):
+        """
+        Draw the static axes once with matplotlib and locate the image box in pixels.
+        """
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        fig = Figure()
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.gca()
+        ax.set_xlabel("Iteration")
+        ax.set_ylabel("Sum Square Error")
+        ax.set_xlim(0, maxIters)
+        ax.set_ylim(0, maxErrors)
+        ax.imshow(np.zeros(shape + (3,)), extent=(0, maxIters, 0, maxErrors))
+        ax.set_aspect(maxIters / maxErrors)
+        ax.set_title("Coronagraph Simulation")
+        canvas.draw()
+        self.buffer = np.array(canvas.buffer_rgba())[:, :, :3]  # Background with the axes, labels and title
+        box = ax.get_window_extent()  # Axes box in pixels, from the bottom left corner
+        height = self.buffer.shape[0]
+        (r0, r1) = (int(round(height - box.y1)), int(round(height - box.y0)))
+        (c0, c1) = (int(round(box.x0)), int(round(box.x1)))
+        self.box = (r0, r1, c0, c1)
+        self.rows = ((np.arange(r1 - r0) + 0.5) * shape[0] / (r1 - r0)).astype(np.intp)  # Image row of each box row
+        self.cols = ((np.arange(c1 - c0) + 0.5) * shape[1] / (c1 - c0)).astype(np.intp)  # Image column of each box column
+        self.scratch = np.empty((r1 - r0, c1 - c0), np.uint8)
+        self.scale = ((c1 - c0) / max(maxIters, 1), (r1 - r0) / maxErrors)
+        self.segments = 0
+        self.lineRows = []
+        self.lineCols = []
+
+    def addSegment(self, k0, e0, k1, e1):
+        """
+        Add the pixels of one segment of the error polyline, two pixels wide.
+        """
+        (r0, r1, c0, c1) = self.box
+        (sx, sy) = self.scale
+        (x0, x1) = (c0 + k0 * sx, c0 + k1 * sx)
+        (y0, y1) = (r1 - e0 * sy, r1 - e1 * sy)
+        n = int(max(abs(x1 - x0), abs(y1 - y0))) + 2  # At least one sample per pixel
+        t = np.linspace(0, 1, n)
+        x = np.rint(x0 + t * (x1 - x0)).astype(np.intp)
+        y = np.rint(y0 + t * (y1 - y0)).astype(np.intp)
+        x = np.concatenate((x, x + 1, x, x + 1)).clip(c0, c1 - 1)
+        y = np.concatenate((y, y, y + 1, y + 1)).clip(r0, r1 - 1)
+        self.lineRows.append(y)
+        self.lineCols.append(x)
+        self.segments += 1
+
+def streamFrames(frames, sinks):
+    """
+    Hand each frame to every sink as soon as it is generated.
+
+    Parameters:
+    - frames (iterable): The (iteration, image, error) tuples, e.g. from gsFrames.
+    - sinks (list): Callables taking (iteration, image, error), with an optional close method.
+
+    Returns:
+    - list: The errors for each iteration.
+    """
+    errors = []
+    try:
+        for k, im, error in frames:
+            errors.append(error)
+            for sink in sinks:
+                sink(k, im, error)
+    finally:
+        for sink in sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+    return errors
+
+class PngSink:
+    """
+    Save each frame to coronagraphK.png over the plot of the errors so far. The error axis
+    grows with the largest error seen, which is the first one when the errors decrease. On
+    close, higher-numbered frames left by a longer earlier run are removed, so coronaAnimate.py
+    does not append them to the video.
+    """
+
+    def __init__(self, maxIters, prefix='coronagraph', show=False, render=None):
+        """
+        Parameters:
+        - maxIters (int): Maximum number of iterations.
+        - prefix (str): The start of the PNG file names.
+        - show (bool): Whether to display each plot.
+        - render (function): A renderer such as FrameRenderer to save with instead of
+          drawing the figure, or None; ignored when showing.
+        """
+        self.maxIters = maxIters
+        self.prefix = prefix
+        self.show = show
+        self.render = render
+        self.errors = []
+
+    def __call__(self, k, im, error):
+        self.errors.append(error)
+        if self.render is None or self.show:
+            saveFrame(k, im, self.errors, self.maxIters, max(self.errors), self.prefix, self.show)
+        else:
+            frame = self.render(im, self.errors, self.maxIters, max(self.errors))
+            plt.imsave(self.prefix + str(k) + '.png', frame)
+        self.last = k
+
+    def close(self):
+        k = getattr(self, 'last', -1) + 1
+        while os.path.exists(self.prefix + str(k) + '.png'):
+            os.remove(self.prefix + str(k) + '.png')  # Stale frame of an earlier run
+            k += 1
+
+class VideoSink:
+    """
+    Encode each frame straight into an MJPG AVI file with OpenCV, as coronaAnimate.py does
+    from the PNG files. The error axis grows with the largest error seen.
+    """
+
+    def __init__(self, filename, maxIters, fps=10, render=None):
+        """
+        Parameters:
+        - filename (str): The name of the AVI file.
+        - maxIters (int): Maximum number of iterations.
+        - fps (int): The frames per second.
+        - render (function): Takes (image, errors, maxIters, maxErrors) and returns a uint8 RGB array,
+          e.g. renderFrame; a new FrameRenderer by default.
+        """
+        import cv2  # Only needed when writing videos
+        self.cv2 = cv2
+        self.filename = filename
+        self.maxIters = maxIters
+        self.fps = fps
+        self.render = render or FrameRenderer()
+        self.errors = []
+        self.video = None
+
+    def __call__(self, k, im, error):
+        self.errors.append(error)
+        frame = self.render(im, self.errors, self.maxIters, max(self.errors))
+        if self.video is None:
+            size = (frame.shape[1], frame.shape[0])
+            code = self.cv2.VideoWriter_fourcc('M','J','P','G')
+            self.video = self.cv2.VideoWriter(self.filename, code, self.fps, size)
+        self.video.write(np.ascontiguousarray(frame[:, :, ::-1]))  # OpenCV expects BGR
+
+    def close(self):
+        if self.video is not None:
+            self.video.release()
+
+class ArraySink:
+    """
+    Store each frame in a memory-mapped .npy file of shape (maxIters + 1, height, width).
+    """
+
+    def __init__(self, filename, maxIters, shape, dtype=np.float64):
+        """
+        Parameters:
+        - filename (str): The name of the .npy file.
+        - maxIters (int): Maximum number of iterations.
+        - shape (tuple): The shape of one frame.
+        - dtype (numpy.dtype): The type of the stored pixels.
+        """
+        self.store = np.lib.format.open_memmap(filename, 'w+', dtype, (maxIters + 1,) + tuple(shape))
+
+    def __call__(self, k, im, error):
+        self.store[k] = im
+
+    def close(self):
+        self.store.flush()
+
+ARCHIVE_MAGIC = b'GSFA'  # Starts and ends a frame archive
+ARCHIVE_VERSION = 2
+ARCHIVE_CODECS = {'bz2': (bz2.compress, bz2.decompress), 'zlib': (zlib.compress, zlib.decompress)}
+
+class ArchiveSink:
+    """
+    Store the frames in a compact archive. Each frame is held as unsigned integers and stored
+    as its difference from the previous one modulo the integer range, which is mostly near
+    zero, with its bytes shuffled into planes and compressed. Every keyframe-th frame is stored
+    whole so any iteration can be decoded without starting from the first. The index of records
+    and the errors are written after the records on close.
+
+    With a renderer, the archive holds the RGB frames the video and PNG files are made of, and
+    replaces the PNG files at about a fifth of their size; the changes between frames are noisy
+    pixels of the image, which no lossless coding shrinks much further. Without one, it holds
+    the simulation frames quantized to 8 bits, or to 16 bits, which keeps the pixels to within
+    1/131070 of the simulation at about five times the size.
+    """
+
+    def __init__(self, filename, maxIters=None, render=None, keyframe=32, dtype=np.uint8, codec='bz2', level=9):
+        """
+        Parameters:
+        - filename (str): The name of the archive file.
+        - maxIters (int): Maximum number of iterations, needed by the renderer.
+        - render (function): Takes (image, errors, maxIters, maxErrors) and returns a uint8 RGB array,
+          e.g. a FrameRenderer, or None to store the simulation frames.
+        - keyframe (int): The number of frames between whole frames.
+        - dtype (numpy.dtype): np.uint8, or np.uint16 for finer simulation frames; rendered frames are uint8.
+        - codec (str): 'bz2', or 'zlib' to write faster at about one and a half times the size.
+        - level (int): The compression level, from 1 for the fastest to 9 for the smallest.
+        """
+        self.file = open(filename, 'wb')
+        self.file.write(ARCHIVE_MAGIC + struct.pack('<B', ARCHIVE_VERSION))
+        self.maxIters = maxIters
+        self.render = render
+        self.keyframe = keyframe
+        self.dtype = np.dtype(np.uint8 if render else dtype)
+        self.scale = np.iinfo(self.dtype).max
+        self.codec = codec
+        self.compress = ARCHIVE_CODECS[codec][0]
+        self.level = level
+        self.errors = []
+        self.records = []  # The offset, length, iteration, keyframe flag and error of each frame
+        self.previous = None
+        self.current = None
+
+    def __call__(self, k, im, error):
+        self.errors.append(error)
+        if self.render:
+            frame = self.render(im, self.errors, self.maxIters, max(self.errors))
+            if self.current is None:
+                self.shape = frame.shape
+                self.previous = np.empty(frame.shape, self.dtype)
+                self.current = np.empty(frame.shape, self.dtype)
+            self.current[...] = frame  # The renderer may reuse its buffer
+        else:
+            if self.current is None:
+                self.shape = im.shape
+                self.work = np.empty(im.shape, np.float64)
+                self.previous = np.empty(im.shape, self.dtype)
+                self.current = np.empty(im.shape, self.dtype)
+            # Quantize without allocating, the frames are already in [0, 1]
+            np.multiply(im, self.scale, out=self.work)
+            np.clip(self.work, 0, self.scale, out=self.work)
+            np.rint(self.work, out=self.work)
+            self.current[...] = self.work
+        key = len(self.records) % self.keyframe == 0
+        if key:
+            data = self.current
+        else:
+            data = np.subtract(self.current, self.previous, dtype=self.dtype)  # Wraps around modulo the integer range
+        payload = self.compress(shuffleBytes(data), self.level)
+        self.records.append([self.file.tell(), len(payload), int(k), key, float(error)])
+        self.file.write(payload)
+        (self.previous, self.current) = (self.current, self.previous)
+
+    def close(self):
+        if self.file.closed:
+            return
+        index = json.dumps({'shape': list(getattr(self, 'shape', (0, 0))), 'dtype': self.dtype.str,
+                            'scale': int(self.scale), 'codec': self.codec, 'rendered': bool(self.render),
+                            'records': self.records}).encode()
+        offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(struct.pack('<Q', offset) + ARCHIVE_MAGIC)
+        self.file.close()
+
+class FrameArchive:
+    """
+    Read the frames of an archive written by ArchiveSink, either one iteration at a time by
+    index, decoding forward from the nearest keyframe, or all of them in order by iterating,
+    which decodes each record once. Iterating yields (iteration, image, error) tuples, so an
+    archive can be passed to streamFrames in place of gsFrames. The images of an archive of
+    rendered frames are uint8 RGB arrays.
+    """
+
+    def __init__(self, filename, dtype=np.float64):
+        """
+        Parameters:
+        - filename (str): The name of the archive file.
+        - dtype (numpy.dtype): The type of the decoded images.
+        """
+        self.file = open(filename, 'rb')
+        try:
+            header = self.file.read(len(ARCHIVE_MAGIC) + 1)
+            if header[:-1] != ARCHIVE_MAGIC or not 1 <= header[-1] <= ARCHIVE_VERSION:
+                raise ValueError("not a frame archive: " + str(filename))
+            self.file.seek(-8 - len(ARCHIVE_MAGIC), os.SEEK_END)
+            footer = self.file.read()
+            if footer[8:] != ARCHIVE_MAGIC:
+                raise ValueError("incomplete frame archive: " + str(filename))
+            (offset,) = struct.unpack('<Q', footer[:8])
+            self.file.seek(offset)
+            index = json.loads(self.file.read()[:-8 - len(ARCHIVE_MAGIC)])
+        except Exception:
+            self.file.close()
+            raise
+        self.shape = tuple(index['shape'])
+        self.stored = np.dtype(index['dtype'])
+        self.scale = index['scale']
+        self.decompress = ARCHIVE_CODECS[index.get('codec', 'zlib')][1]  # Version 1 archives are zlib only
+        self.rendered = index.get('rendered', False)
+        self.records = index['records']
+        self.errors = [record[4] for record in self.records]
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError("frame %d of %d" % (i, len(self)))
+        i %= len(self)
+        first = max(j for j in range(i + 1) if self.records[j][3])  # The nearest keyframe at or before i
+        q = None
+        for j in range(first, i + 1):
+            q = self.decode(j, q)
+        return self.image(q)
+
+    def __iter__(self):
+        q = None
+        for j, record in enumerate(self.records):
+            q = self.decode(j, q)
+            yield record[2], self.image(q), record[4]
+
+    def decode(self, j, previous):
+        """
+        Decode the quantized frame of one record.
+
+        Parameters:
+        - j (int): The record number.
+        - previous (numpy.ndarray): The quantized previous frame, or None for a keyframe; updated in place.
+
+        Returns:
+        - numpy.ndarray: The quantized frame.
+        """
+        (offset, length, k, key, error) = self.records[j]
+        self.file.seek(offset)
+        data = unshuffleBytes(self.decompress(self.file.read(length)), self.stored, self.shape)
+        if key or previous is None:
+            return data
+        np.add(previous, data, out=previous, dtype=self.stored)  # Undo the difference modulo the integer range
+        return previous
+
+    def image(self, q):
+        """
+        Scale a quantized frame back to [0, 1], or copy a rendered frame.
+        """
+        if self.rendered:
+            return q.copy()  # Decoding continues in q
+        im = q.astype(self.dtype)
+        im /= self.scale
+        return im
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def shuffleBytes(a):
+    """
+    Group the bytes of an integer array by significance, so the mostly constant high bytes of
+    small differences compress into long runs.
+
+    Parameters:
+    - a (numpy.ndarray): The input array.
+
+    Returns:
+    - bytes: The shuffled bytes.
+    """
+    if a.itemsize == 1:
+        return a.tobytes()
+    return np.ascontiguousarray(a.reshape(-1).view(np.uint8).reshape(-1, a.itemsize).T).tobytes()
+
+def unshuffleBytes(data, dtype, shape):
+    """
+    Reverse shuffleBytes.
+
+    Parameters:
+    - data (bytes): The shuffled bytes.
+    - dtype (numpy.dtype): The type of the array.
+    - shape (tuple): The shape of the array.
+
+    Returns:
+    - numpy.ndarray: The array.
+    """
+    planes = np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1)
+    return planes.T.copy().view(dtype).reshape(shape)  # A writable copy, decoding adds to it in place
 
-main() # Call the main function to run the simulation
+if __name__ == '__main__':
+    main() # Call the main function to run the simulation